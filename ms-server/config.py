@@ -30,6 +30,35 @@ class AppConfigModel(BaseModel):
   RestrictLanguage: bool = False # to avoid strange language recognition
   AllowedLanguages: List[str] = ['zh', 'en', 'jp'] 
   TranslationTarget: str = 'en'
+  LanguagePinning: bool = True # detect once and reuse the language
+  LanguageRedetectInterval: float = 60 # in seconds of audio
+  
+  VoiceActivityGate: bool = True # skip transcription of silent audio
+  StreamingTranscription: bool = False # only re-transcribe the unstable tail
+  TranscriptionModel: str = 'medium'
+  PartialModel: str = '' # small model for partial results, empty to use TranscriptionModel
+  PreloadModels: List[str] = [] # loaded at startup and kept warm
+  ModelMemoryBudget: int = 0 # in MiB, idle models are evicted beyond it, 0 to keep only PreloadModels idle
+  DecodingProfile: str = 'fast' # default, fast, balanced or accurate; the last two decode each committed span again
+  AudioContextBucket: int = 0 # trim the encoder context to the window in steps of 20ms * this, 0 to disable
+  TranscriptionProcess: bool = False # host the model in a dedicated process
+  TranscriptionThreads: int = 0 # torch threads of that process, 0 for default
+  InferenceWorkers: int = 1 # threads running in-process inference
+  InferenceThreads: int = 0 # torch intra-op threads per inference thread, 0 for default
+  InferenceInteropThreads: int = 0 # torch inter-op threads, 0 for default
+  BatchInference: bool = False # decode the windows of concurrent meetings in one batch, no gain with a single meeting
+  MelCache: bool = False # reuse the log-mel frames of retained audio across passes
+  ModelQuantization: bool = False # int8 linear layers for CPU inference
+  QuantizedModelDir: str = './models/' # cache of quantized weights
+  AudioBufferLimit: float = 60 # seconds of audio kept per meeting, the oldest is dropped beyond it
+  MaxTranscriptionLag: float = 30 # seconds of buffered audio before backpressure applies
+  BackpressureStrategy: str = 'drop_oldest' # drop_oldest, skip_to_live or throttle
+  TranscriptFlushBatch: int = 64 # transcript rows written per transaction
+  TranscriptFlushInterval: float = 0.5 # in seconds, longest a row waits before being written
+  TranscriptJournalLimit: int = 4096 # unwritten rows before the transcription loop waits
+  SessionDatabaseCache: int = 8 # session databases kept open
+  SessionDatabaseIdleTimeout: float = 300 # in seconds, unused session databases are closed after it
+  MeetingArchive: bool = True # move the records of closed meetings to a compressed archive
   
   @field_serializer('AccessTokenExpires', 'RefreshTokenExpires')
   def serialize_timedelta(self, delta: timedelta):
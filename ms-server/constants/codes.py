@@ -17,6 +17,12 @@ class Codes:
   ERR_SESSION_DB = 80
   ERR_MEETING_STARTED = 81, 'Meeting already started.', 400
   ERR_MEETING_NOT_STARTED = 82, 'Meeting not started.', 400
+  ERR_UNSUPPORTED_FORMAT = 83, 'Unsupported audio format.', 400
+  ERR_EXPORT_FORMAT = 84, 'Unsupported export format.', 400
+  ERR_INVALID_CURSOR = 85, 'Invalid cursor.', 400
+  ERR_UNKNOWN_PROFILE = 86, 'Unknown decoding profile.', 400
+  ERR_INVALID_SESSION = 87, 'Invalid session name.', 400
+  ERR_SESSION_NOT_FOUND = 88, 'Session not found.', 404
   
 def _gen_desc():
   res = {}
@@ -1,10 +1,12 @@
 from typing import Optional
 
+import asyncio
 from datetime import datetime
 from datetime import datetime
 from pydantic import BaseModel
 
 from fastapi import Depends, HTTPException, WebSocket
+from fastapi.responses import StreamingResponse
 
 from base import app, BaseResponseModel, TokenResponseModel
 from user.model import User
@@ -12,7 +14,12 @@ from user.auth import CurrentUser, create_jwt_token
 from constants import Token, Codes, getDescriptionHttp
 from config import AppConfig
 
-from meeting.model import initialize_db
+from meeting.model import session_databases, valid_session
+from meeting.search import search_index
+from meeting.export import EXPORT_MEDIA_TYPES, iter_record_pages, iter_archive_pages, stream_export, record_dict, encode_cursor, decode_cursor
+from transcribe.registry import model_registry
+from transcribe.w_whisper import DECODING_PROFILES
+from transcribe.executor import inference_executor
 from meeting.handler import MeetingHandler
 from meeting.ws import send_transcription, get_handler, set_handler, ProviderHandler, ConsumerHandler
 
@@ -22,10 +29,16 @@ class InitParams(BaseModel):
   session: Optional[str] = None
   name: Optional[str] = None
   time: Optional[datetime] = None
+  profile: Optional[str] = None
 
 
 _emst = getDescriptionHttp(Codes.ERR_MEETING_STARTED)
 _emns = getDescriptionHttp(Codes.ERR_MEETING_NOT_STARTED)
+_eexf = getDescriptionHttp(Codes.ERR_EXPORT_FORMAT)
+_eicr = getDescriptionHttp(Codes.ERR_INVALID_CURSOR)
+_eupf = getDescriptionHttp(Codes.ERR_UNKNOWN_PROFILE)
+_eisn = getDescriptionHttp(Codes.ERR_INVALID_SESSION)
+_esnf = getDescriptionHttp(Codes.ERR_SESSION_NOT_FOUND)
 
 
 @app.post('/api/meet/init', response_model_exclude_none=True)
@@ -35,14 +48,26 @@ async def init(
 ) -> BaseResponseModel:
   if get_handler() is not None:
     raise HTTPException(**_emst)
+  if form_data.session and not valid_session(form_data.session):
+    raise HTTPException(**_eisn)
   h = MeetingHandler(
       callback=send_transcription,
       session=form_data.session,
       name=form_data.name,
-      time=form_data.time
+      time=form_data.time,
+      profile=form_data.profile,
   )
+  # the requested profile, or the configured one
+  if h.profile not in DECODING_PROFILES:
+    raise HTTPException(**_eupf)
   set_handler(h)
-  await h.init()
+  try:
+    await h.init()
+  except BaseException:
+    # a meeting that failed to start must not block the next one
+    set_handler(None)
+    await h.close()
+    raise
   h.start_providing()
   return BaseResponseModel(detail={'user': user.email if user else None})
 
@@ -60,6 +85,19 @@ async def close(
   return BaseResponseModel(detail={'user': user.email if user else None})
 
 
+@app.on_event('startup')
+async def preload_models():
+  options = dict(quantize=True) if AppConfig.ModelQuantization else {}
+  for name in AppConfig.PreloadModels:
+    asyncio.create_task(model_registry.preload(name, **options))
+
+
+@app.on_event('shutdown')
+async def close_databases():
+  await session_databases.close_all()
+  await search_index.close()
+
+
 # websocket related
 
 def request_websocket(
@@ -88,8 +126,8 @@ async def request_websocket(
   return request_websocket(user, False)
 
 @app.websocket('/ws/meet/provide')
-async def provide(websocket: WebSocket, token: str, format: str):
-  h = ProviderHandler(websocket, token, format)
+async def provide(websocket: WebSocket, token: str, format: str = 'float32', rate: int = 16000, channels: int = 1):
+  h = ProviderHandler(websocket, token, format, rate, channels)
   await h.work()
 
 @app.websocket('/ws/meet/consume')
@@ -97,17 +135,118 @@ async def consume(websocket: WebSocket, token: str):
   h = ConsumerHandler(websocket, token)
   await h.work()
 
+@app.get('/api/meet/stats', response_model_exclude_none=True)
+async def stats(
+    user: User = Depends(CurrentUser(Token.Access.Meeting.InitOrClose))
+) -> BaseResponseModel:
+  h = get_handler()
+  if h is None:
+    raise HTTPException(**_emns)
+  return BaseResponseModel(detail={**h.get_stats(), 'inference': inference_executor.get_stats()})
+
+
 
 # data
 
-@app.get('/api/meet/data')
+@app.get('/api/meet/data', response_model_exclude_none=True)
 async def download_data(
     time_start: datetime,
     time_end: Optional[datetime] = None,
+    session: Optional[str] = None,
+    lang: Optional[str] = None,
+    format: str = 'json',
+    cursor: Optional[str] = None,
+    limit: int = 200,
     user: User = Depends(CurrentUser(Token.Access.Meeting.Data)),
 ):
-  # TODO
-  return '[]'
+  '''Records of `session`, the current meeting's by default, in time order.
+
+  `json` returns a page of at most `limit` records and the cursor of the
+  next page, if any. The other formats stream every record after `cursor`.
+  Subtitle cues are timed from `time_start`.
+  '''
+  if format not in EXPORT_MEDIA_TYPES:
+    raise HTTPException(**_eexf)
+  try:
+    after = decode_cursor(cursor) if cursor else None
+  except ValueError:
+    raise HTTPException(**_eicr)
+  h = get_handler()
+  if not session:
+    session = h.session if h is not None else 'default'
+  if not valid_session(session):
+    raise HTTPException(**_eisn)
+
+  live = h is not None and h.session == session
+  # the rows transcribed but not written yet
+  pending = await h.writer.snapshot() if live and h.writer is not None else None
+
+  # a closed meeting that was archived is read without opening its database
+  reader = session_databases.archived(session) if not live else None
+  database = None
+  if reader is None:
+    if not live and not session_databases.exists(session):
+      raise HTTPException(**_esnf)
+    # only the live meeting writes, exports of other sessions cannot
+    database = await session_databases.acquire(session, readonly=not live)
+
+  def _pages(page_size):
+    if reader is not None:
+      return iter_archive_pages(reader, session, time_start, time_end, lang, after, page_size)
+    return iter_record_pages(database, session, time_start, time_end, lang, after, page_size, pending)
+
+  def _done():
+    if reader is not None:
+      reader.close()
+    else:
+      session_databases.release(database)
+
+  if format == 'json':
+    try:
+      limit = min(max(limit, 1), 1000)
+      pages = _pages(limit)
+      records = []
+      async for records in pages:
+        break
+      await pages.aclose()
+    finally:
+      _done()
+    return BaseResponseModel(detail={
+        'records': [record_dict(r) for r in records],
+        'cursor': encode_cursor(records[-1]) if len(records) == limit else None,
+    })
+
+  async def _stream():
+    try:
+      async for chunk in stream_export(_pages(500), format, time_start):
+        yield chunk
+    finally:
+      _done()
+
+  return StreamingResponse(
+      _stream(),
+      media_type=EXPORT_MEDIA_TYPES[format],
+      headers={'Content-Disposition': f'attachment; filename="{session}.{format}"'},
+  )
 
 
-initialize_db()
+@app.get('/api/meet/search', response_model_exclude_none=True)
+async def search(
+    q: str,
+    session: Optional[str] = None,
+    time_start: Optional[datetime] = None,
+    time_end: Optional[datetime] = None,
+    lang: Optional[str] = None,
+    limit: int = 20,
+    user: User = Depends(CurrentUser(Token.Access.Meeting.Data)),
+) -> BaseResponseModel:
+  '''Records and translations of every meeting matching all words of `q`,
+  best first.
+  '''
+  h = get_handler()
+  pending = []
+  if h is not None and h.writer is not None and (not session or session == h.session):
+    _, pending = await h.writer.snapshot()
+  results = await search_index.search(
+      q, session, time_start, time_end, lang, min(max(limit, 1), 100), pending)
+  return BaseResponseModel(detail=results)
@@ -0,0 +1,282 @@
+"""
+Archive file layout, append-only:
+
+  MAGIC
+  block, block, ...          first segment
+  footer, trailer
+  block, block, ...          appended segment
+  footer, trailer            the last one describes every block
+
+A block holds up to BLOCK_ROWS records sorted by (time, id), one zlib
+stream per column. The footer is zlib compressed JSON listing the blocks
+with their time range, which serves as a sparse time index, and the
+trailer gives the position of the footer.
+"""
+from typing import Optional, List, Dict, Any, Iterable, Iterator, Tuple
+
+import os
+import mmap
+import json
+import zlib
+import heapq
+import struct
+import numpy as np
+from datetime import datetime, timedelta
+
+
+MAGIC = b'MSARCH01'
+BLOCK_ROWS = 1024
+TEXT_COLUMNS = ('text', 'translate1', 'translate2', 'translate3', 'translate4')
+COLUMNS = ('id', 'time', 'lang') + TEXT_COLUMNS
+
+_TRAILER = struct.Struct('<QI8s')  # footer offset, footer size, magic
+_EPOCH = datetime.utcfromtimestamp(0)
+_US = timedelta(microseconds=1)
+
+Cursor = Tuple[datetime, int]  # (time, id)
+
+
+class ArchiveError(Exception):
+  pass
+
+
+def _to_us(time: datetime) -> int:
+  return (time - _EPOCH) // _US
+
+
+def _from_us(us: int) -> datetime:
+  return _EPOCH + timedelta(microseconds=us)
+
+
+def _encode_texts(values: List[str]) -> bytes:
+  data = [v.encode('utf-8') for v in values]
+  lengths = np.fromiter((len(d) for d in data), dtype='<u4', count=len(data))
+  return lengths.tobytes() + b''.join(data)
+
+
+def _decode_texts(raw: bytes, rows: int) -> List[str]:
+  lengths = np.frombuffer(raw, dtype='<u4', count=rows)
+  ends = np.cumsum(lengths) + rows * 4
+  starts = ends - lengths
+  return [raw[s:e].decode('utf-8') for s, e in zip(starts.tolist(), ends.tolist())]
+
+
+def _locate_footer(data) -> Tuple[int, Dict[str, Any]]:
+  '''Footer of the last complete segment, and the end of its trailer.
+  An append interrupted before its trailer leaves the previous one valid.
+  '''
+  end = len(data)
+  while True:
+    i = data.rfind(MAGIC, 0, end)
+    trailer = i + len(MAGIC) - _TRAILER.size
+    if trailer < len(MAGIC):
+      raise ArchiveError('No valid footer')
+    offset, size, _ = _TRAILER.unpack_from(data, trailer)
+    if offset + size == trailer:
+      try:
+        return i + len(MAGIC), json.loads(zlib.decompress(data[offset:trailer]))
+      except (zlib.error, ValueError):
+        pass
+    end = i
+
+
+class ArchiveWriter:
+  '''Appends a segment of records, which must come sorted by (time, id), to
+  the archive at `path`. Nothing is visible to readers before `close`.
+
+  `filled` maps a language to the translation column that records of that
+  language fill with their own text, which is then not stored twice.
+  '''
+
+  def __init__(self, path: str, session: str, filled: Dict[str, str]):
+    self.path = path
+    self.rows: List[Dict[str, Any]] = []
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+      with open(path, 'rb') as f:
+        data = f.read()
+      self.size, self.footer = _locate_footer(data)
+      self.file = open(path, 'r+b')
+      self.file.truncate(self.size)  # drop an interrupted append
+      self.file.seek(self.size)
+      self.footer['segments'] += 1
+    else:
+      self.file = open(path, 'wb')
+      self.file.write(MAGIC)
+      self.size = 0
+      self.footer = dict(
+          version=1, session=session, columns=list(COLUMNS),
+          filled=filled, langs=[], blocks=[], segments=1, through=0,
+      )
+    self.langs = {lang: i for i, lang in enumerate(self.footer['langs'])}
+
+  def add(self, records: Iterable[Dict[str, Any]]):
+    self.rows.extend(records)
+    while len(self.rows) >= BLOCK_ROWS:
+      self._write_block(self.rows[:BLOCK_ROWS])
+      del self.rows[:BLOCK_ROWS]
+
+  def _lang(self, lang: str) -> int:
+    if lang not in self.langs:
+      self.langs[lang] = len(self.footer['langs'])
+      self.footer['langs'].append(lang)
+    return self.langs[lang]
+
+  def _write_block(self, rows: List[Dict[str, Any]]):
+    ids = np.array([r['id'] for r in rows], dtype='<i8')
+    times = np.array([_to_us(r['time']) for r in rows], dtype='<i8')
+    langs = np.array([self._lang(r['lang']) for r in rows], dtype='<u2')
+    filled = self.footer['filled']
+    columns = [
+        np.diff(ids, prepend=0).astype('<i8').tobytes(),
+        np.diff(times, prepend=0).astype('<i8').tobytes(),
+        langs.tobytes(),
+    ] + [
+        _encode_texts([
+            '' if column != 'text' and filled.get(r['lang']) == column else (r[column] or '')
+            for r in rows
+        ])
+        for column in TEXT_COLUMNS
+    ]
+
+    offset = self.file.tell()
+    sizes = []
+    for raw in columns:
+      packed = zlib.compress(raw, 6)
+      self.file.write(packed)
+      sizes.append(len(packed))
+    self.footer['blocks'].append(dict(
+        offset=offset, sizes=sizes, rows=len(rows),
+        time_min=int(times.min()), time_max=int(times.max()),
+        langs=sorted(set(langs.tolist())), segment=self.footer['segments'],
+    ))
+    self.footer['through'] = max(self.footer['through'], int(ids.max()))
+
+  def close(self):
+    if self.rows:
+      self._write_block(self.rows)
+      self.rows = []
+    footer = zlib.compress(json.dumps(self.footer, separators=(',', ':')).encode('utf-8'))
+    offset = self.file.tell()
+    self.file.write(footer)
+    self.file.write(_TRAILER.pack(offset, len(footer), MAGIC))
+    self.file.flush()
+    os.fsync(self.file.fileno())
+    self.file.close()
+
+  def abort(self):
+    '''Drop what was appended since opening.
+    '''
+    self.file.truncate(self.size)
+    self.file.close()
+    if not self.size:
+      os.remove(self.path)
+
+
+class ArchiveReader:
+  '''Memory-mapped read access to an archive. Only the blocks overlapping
+  the requested time range are decompressed, and of those only the
+  columns needed to filter until a row is kept.
+  '''
+
+  def __init__(self, path: str):
+    self.path = path
+    with open(path, 'rb') as f:
+      self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    self.size = len(self.map)
+    _, self.footer = _locate_footer(self.map)
+    self.blocks = self.footer['blocks']
+    self.langs: List[str] = self.footer['langs']
+    self.filled: Dict[str, str] = self.footer['filled']
+    self.through: int = self.footer['through']  # highest record id archived
+    self.time_min = np.array([b['time_min'] for b in self.blocks], dtype=np.int64)
+    self.time_max = np.array([b['time_max'] for b in self.blocks], dtype=np.int64)
+
+  def _columns(self, block: Dict[str, Any]) -> List[bytes]:
+    offset = block['offset']
+    spans = []
+    for size in block['sizes']:
+      spans.append(self.map[offset:offset + size])
+      offset += size
+    return spans
+
+  def _read_block(
+      self,
+      block: Dict[str, Any],
+      time_start: Optional[int],
+      time_end: Optional[int],
+      lang: Optional[str],
+      after: Optional[Tuple[int, int]],
+  ) -> Iterator[Dict[str, Any]]:
+    rows = block['rows']
+    spans = self._columns(block)
+    ids = np.cumsum(np.frombuffer(zlib.decompress(spans[0]), dtype='<i8', count=rows))
+    times = np.cumsum(np.frombuffer(zlib.decompress(spans[1]), dtype='<i8', count=rows))
+    langs = np.frombuffer(zlib.decompress(spans[2]), dtype='<u2', count=rows)
+
+    keep = np.ones((rows,), dtype=bool)
+    if time_start is not None:
+      keep &= times >= time_start
+    if time_end is not None:
+      keep &= times <= time_end
+    if lang:
+      codes = [i for i, l in enumerate(self.langs) if l.startswith(lang)]
+      keep &= np.isin(langs, codes)
+    if after is not None:
+      keep &= (times > after[0]) | ((times == after[0]) & (ids > after[1]))
+    indices = np.flatnonzero(keep)
+    if indices.size == 0:
+      return
+
+    texts = [_decode_texts(zlib.decompress(span), rows) for span in spans[3:]]
+    for i in indices.tolist():
+      row = dict(
+          id=int(ids[i]),
+          time=_from_us(int(times[i])),
+          lang=self.langs[langs[i]],
+          session=self.footer['session'],
+      )
+      for column, values in zip(TEXT_COLUMNS, texts):
+        row[column] = values[i]
+      column = self.filled.get(row['lang'])
+      if column is not None and not row[column]:
+        row[column] = row['text']
+      yield row
+
+  def read(
+      self,
+      time_start: Optional[datetime] = None,
+      time_end: Optional[datetime] = None,
+      lang: Optional[str] = None,
+      after: Optional[Cursor] = None,
+  ) -> Iterator[Dict[str, Any]]:
+    '''Records in (time, id) order, as dicts of the record columns.
+    '''
+    start = _to_us(time_start) if time_start is not None else None
+    end = _to_us(time_end) if time_end is not None else None
+    after_us = (_to_us(after[0]), after[1]) if after is not None else None
+    lower = max(start if start is not None else -2**63, after_us[0] if after_us else -2**63)
+
+    # the sparse index: blocks overlapping [lower, end]
+    candidates = self.time_max >= lower
+    if end is not None:
+      candidates &= self.time_min <= end
+    codes = {i for i, l in enumerate(self.langs) if l.startswith(lang)} if lang else None
+    segments: Dict[int, List[Dict[str, Any]]] = {}
+    for i in np.flatnonzero(candidates).tolist():
+      block = self.blocks[i]
+      if codes is not None and not codes.intersection(block['langs']):
+        continue
+      segments.setdefault(block['segment'], []).append(block)
+
+    def _segment(blocks):
+      for block in blocks:
+        yield from self._read_block(block, start, end, lang, after_us)
+
+    # segments are each sorted, but may overlap in time
+    yield from heapq.merge(
+        *(_segment(blocks) for blocks in segments.values()),
+        key=lambda r: (r['time'], r['id']),
+    )
+
+  def close(self):
+    self.map.close()
@@ -0,0 +1,93 @@
+from typing import Dict, Any, Set, Callable, Awaitable
+
+import logging
+
+from transcribe.worker import TranscribeWorker
+
+default_logger = logging.getLogger(__name__)
+
+BACKPRESSURE_STRATEGIES = ('drop_oldest', 'skip_to_live', 'throttle')
+
+
+class BackpressurePolicy:
+  '''Keeps the audio buffered by a meeting's worker within `max_lag`
+  seconds when transcription falls behind.
+
+  - drop_oldest: discard the oldest audio beyond `max_lag`.
+  - skip_to_live: discard all but the last `live_lag` seconds and start a
+    new utterance there.
+  - throttle: ask the providers to pause until the lag is back under
+    `resume_ratio * max_lag`. The worker's buffer limit still applies
+    to providers that keep sending.
+  '''
+
+  def __init__(
+      self,
+      strategy: str = 'drop_oldest',
+      max_lag: float = 30,  # in seconds
+      live_lag: float = 2,  # in seconds
+      resume_ratio: float = 0.5,
+  ):
+    if strategy not in BACKPRESSURE_STRATEGIES:
+      raise ValueError(f'Unknown backpressure strategy: {strategy}')
+    self.strategy = strategy
+    self.max_lag = max_lag
+    self.live_lag = live_lag
+    self.resume_ratio = resume_ratio
+
+    self.throttled = False
+    self.lag = 0.0  # in seconds
+    self.peak_lag = 0.0  # in seconds
+    self.dropped = 0.0  # seconds of audio discarded by the policy
+    self.skips = 0
+    self.throttles = 0
+
+    # called with the new throttle state when it changes
+    self.listeners: Set[Callable[[bool], Awaitable]] = set()
+
+  async def apply(self, worker: TranscribeWorker) -> bool:
+    '''Check the lag after audio is enqueued or transcribed, and act on it.
+    Returns whether the throttle state changed, see `notify`.
+    '''
+    lag = worker.buffered_duration()
+    self.lag = lag
+    self.peak_lag = max(self.peak_lag, lag)
+
+    if self.strategy == 'throttle':
+      if not self.throttled and lag > self.max_lag:
+        self.throttled = True
+        self.throttles += 1
+        return True
+      elif self.throttled and lag < self.max_lag * self.resume_ratio:
+        self.throttled = False
+        return True
+      return False
+
+    if lag <= self.max_lag:
+      return False
+    if self.strategy == 'drop_oldest':
+      self.dropped += await worker.drop_audio(self.max_lag)
+    else:
+      self.dropped += await worker.drop_audio(self.live_lag, new_utterance=True)
+      self.skips += 1
+    self.lag = worker.buffered_duration()
+    return False
+
+  async def notify(self):
+    for listener in list(self.listeners):
+      try:
+        await listener(self.throttled)
+      except Exception as e:  # a provider going away must not stop transcription
+        default_logger.warning(f'Failed to notify backpressure: {e!r}')
+
+  def get_stats(self) -> Dict[str, Any]:
+    return dict(
+        strategy=self.strategy,
+        max_lag=self.max_lag,
+        lag=self.lag,
+        peak_lag=self.peak_lag,
+        dropped=self.dropped,
+        skips=self.skips,
+        throttles=self.throttles,
+        throttled=self.throttled,
+    )
@@ -0,0 +1,252 @@
+from typing import Optional, Tuple, List, Dict, Any, AsyncIterator
+
+import io
+import csv
+import heapq
+import json
+from datetime import datetime, timedelta, timezone
+
+from meeting.model import SessionDatabase, MeetingRecord, _TRANSLATE_ORDER
+from meeting.archive import ArchiveReader
+
+EXPORT_MEDIA_TYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+    'srt': 'application/x-subrip; charset=utf-8',
+    'vtt': 'text/vtt; charset=utf-8',
+}
+
+_CUE_MAX = timedelta(seconds=10)  # longest a subtitle stays when the next one is later
+_CSV_COLUMNS = ['id', 'time', 'lang', 'text'] + [f'translate_{lang}' for lang in _TRANSLATE_ORDER]
+
+Cursor = Tuple[datetime, int]  # (time, id) of the last record sent
+
+
+def to_ms(time: datetime) -> int:
+  return int(time.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def encode_cursor(record: MeetingRecord) -> str:
+  return f'{to_ms(record.time)}-{record.id}'
+
+
+def decode_cursor(cursor: str) -> Cursor:
+  '''Raises ValueError if `cursor` was not made by `encode_cursor`.
+  '''
+  ms, _, id = cursor.partition('-')
+  return datetime.utcfromtimestamp(int(ms) / 1000), int(id)
+
+
+async def _database_pages(database, where_clause, after, page_size):
+  Record = database.MeetingRecord
+  while True:
+    page_clause = where_clause
+    if after is not None:
+      time, id = after
+      page_clause = page_clause & ((Record.time > time) | ((Record.time == time) & (Record.id > id)))
+    query = Record.select().where(page_clause).order_by(Record.time, Record.id).limit(page_size)
+    page = list(await database.objects.execute(query))
+    if page:
+      yield page
+    if len(page) < page_size:
+      break
+    after = page[-1].time, page[-1].id
+
+
+def _archived_records(reader: ArchiveReader, Record, session, time_start, time_end, lang, after):
+  return (
+      Record(**row) for row in reader.read(time_start, time_end, lang, after)
+      if row['session'] == session
+  )
+
+
+async def iter_archive_pages(
+    reader: ArchiveReader,
+    session: str,
+    time_start: datetime,
+    time_end: Optional[datetime] = None,
+    lang: Optional[str] = None,
+    after: Optional[Cursor] = None,
+    page_size: int = 500,
+) -> AsyncIterator[List[MeetingRecord]]:
+  '''`iter_record_pages` of a session whose records are all archived,
+  read from the archive alone.
+  '''
+  out = []
+  for record in _archived_records(reader, MeetingRecord, session, time_start, time_end, lang, after):
+    out.append(record)
+    if len(out) >= page_size:
+      yield out
+      out = []
+  if out:
+    yield out
+
+
+def _after(record: MeetingRecord, after: Optional[Cursor]) -> bool:
+  return after is None or (record.time, record.id) > after
+
+
+async def iter_record_pages(
+    database: SessionDatabase,
+    session: str,
+    time_start: datetime,
+    time_end: Optional[datetime] = None,
+    lang: Optional[str] = None,
+    after: Optional[Cursor] = None,
+    page_size: int = 500,
+    pending: Optional[Tuple[int, List[MeetingRecord]]] = None,
+) -> AsyncIterator[List[MeetingRecord]]:
+  '''Records in (time, id) order, a page per query. Each page continues
+  after the last record of the previous one, so a query only reads its
+  own rows of the (session, time) index whatever the offset. Archived
+  records are merged in from the archive, and `pending`, a snapshot of
+  the writer of the session, from memory.
+  '''
+  Record = database.MeetingRecord
+  where_clause = (Record.session == session) & (Record.time >= time_start)
+  if time_end is not None:
+    where_clause = where_clause & (Record.time <= time_end)
+  if lang:
+    where_clause = where_clause & (Record.lang.startswith(lang))
+
+  sources = []
+  reader = database.archive()
+  if reader is not None:
+    sources.append(_archived_records(reader, Record, session, time_start, time_end, lang, after))
+    where_clause = where_clause & (Record.id > reader.through)
+  if pending is not None:
+    last_id, records = pending
+    sources.append(sorted((
+        r for r in records
+        if r.session == session and r.time >= time_start
+        and (time_end is None or r.time <= time_end)
+        and (not lang or r.lang.startswith(lang)) and _after(r, after)
+    ), key=lambda r: (r.time, r.id)))
+    where_clause = where_clause & (Record.id <= last_id)
+  if not sources:
+    async for page in _database_pages(database, where_clause, after, page_size):
+      yield page
+    return
+
+  merged = heapq.merge(*sources, key=lambda r: (r.time, r.id))
+  extra = next(merged, None)
+  out = []
+  async for page in _database_pages(database, where_clause, after, page_size):
+    for record in page:
+      while extra is not None and (extra.time, extra.id) < (record.time, record.id):
+        out.append(extra)
+        extra = next(merged, None)
+        if len(out) >= page_size:
+          yield out
+          out = []
+      out.append(record)
+      if len(out) >= page_size:
+        yield out
+        out = []
+  while extra is not None:
+    out.append(extra)
+    extra = next(merged, None)
+    if len(out) >= page_size:
+      yield out
+      out = []
+  if out:
+    yield out
+
+
+def record_dict(record: MeetingRecord) -> Dict[str, Any]:
+  return dict(
+      id=record.id,
+      time=to_ms(record.time),
+      lang=record.lang,
+      text=record.text,
+      translations={
+          lang: getattr(record, key)
+          for lang, (_, key) in _TRANSLATE_ORDER.items()
+          if getattr(record, key)
+      },
+  )
+
+
+def _cue_time(delta: timedelta, separator: str) -> str:
+  ms = max(int(delta.total_seconds() * 1000), 0)
+  s, ms = divmod(ms, 1000)
+  m, s = divmod(s, 60)
+  h, m = divmod(m, 60)
+  return f'{h:02d}:{m:02d}:{s:02d}{separator}{ms:03d}'
+
+
+class _Encoder:
+  '''Text of an export format, a chunk per page of records.
+  '''
+
+  def __init__(self, format: str, origin: datetime):
+    self.format = format
+    self.origin = origin  # time 0 of subtitle cues
+    self.count = 0
+    self.held: Optional[MeetingRecord] = None  # waits for the next cue to know its end
+
+  def header(self) -> str:
+    if self.format == 'vtt':
+      return 'WEBVTT\n\n'
+    if self.format == 'csv':
+      return self._csv_rows([_CSV_COLUMNS])
+    return ''
+
+  def _csv_rows(self, rows: List[List[Any]]) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+  def _cue(self, record: MeetingRecord, end: datetime) -> str:
+    self.count += 1
+    separator = ',' if self.format == 'srt' else '.'
+    start = _cue_time(record.time - self.origin, separator)
+    end = _cue_time(end - self.origin, separator)
+    text = record.text.strip().replace('\n\n', '\n')
+    index = f'{self.count}\n' if self.format == 'srt' else ''
+    return f'{index}{start} --> {end}\n{text}\n\n'
+
+  def page(self, records: List[MeetingRecord]) -> str:
+    if self.format == 'ndjson':
+      return ''.join(json.dumps(record_dict(r), ensure_ascii=False) + '\n' for r in records)
+    if self.format == 'csv':
+      return self._csv_rows([
+          [r.id, r.time.isoformat(), r.lang, r.text] +
+          [getattr(r, key) for _, key in _TRANSLATE_ORDER.values()]
+          for r in records
+      ])
+    chunks = []
+    for record in records:
+      if not record.text.strip():
+        continue  # an empty cue ends the block early
+      if self.held is not None:
+        chunks.append(self._cue(self.held, min(record.time, self.held.time + _CUE_MAX)))
+      self.held = record
+    return ''.join(chunks)
+
+  def footer(self) -> str:
+    if self.held is not None and self.format in ('srt', 'vtt'):
+      return self._cue(self.held, self.held.time + _CUE_MAX)
+    return ''
+
+
+async def stream_export(
+    pages: AsyncIterator[List[MeetingRecord]],
+    format: str,
+    origin: datetime,
+) -> AsyncIterator[str]:
+  '''Encode record pages as `format`, yielding a chunk per page so memory
+  stays at one page whatever the length of the meeting.
+  '''
+  encoder = _Encoder(format, origin)
+  chunk = encoder.header()
+  if chunk:
+    yield chunk
+  async for page in pages:
+    chunk = encoder.page(page)
+    if chunk:
+      yield chunk
+  chunk = encoder.footer()
+  if chunk:
+    yield chunk
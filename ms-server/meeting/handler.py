@@ -1,19 +1,27 @@
 import asyncio
-from typing import Optional, Callable
+import time
+from typing import Optional, Callable, Iterable, Tuple
 from numpy.typing import NDArray
 import numpy as np
 
 from datetime import datetime
 
 from transcribe.worker import TranscribeWorker, TranscriptionResult
-from transcribe.w_whisper import WhisperWorker
+from transcribe.w_whisper import WhisperWorker, DECODING_PROFILES
+from transcribe.w_process import WhisperProcessWorker
+from transcribe.w_cascade import WhisperCascadeWorker
+from transcribe.vad import EnergyVAD
+from transcribe.language import LanguageTracker
 
 from translate.worker import TranslateWorker
 from translate.w_deepl import DeepLWorker
 
 from config import AppConfig
 
-from meeting.model import initialize_db, add_record, update_translations, TranslationResult
+from meeting.scheduler import TranscriptionScheduler
+from meeting.backpressure import BackpressurePolicy
+from meeting.model import SessionDatabase, session_databases, update_translations, archive_records, TranslationResult
+from meeting.writer import TranscriptWriter
 
 DEBUG_MODE = False
 
@@ -25,41 +33,92 @@ class MeetingHandler:
       session: str = 'default',
       name: Optional[str] = None,
       time: Optional[datetime] = None,
+      profile: Optional[str] = None,
       work_duration: float = 0.7, # in seconds
       dummy_threshold: int = 4,
   ):
     self.callback = callback
     self.session = session or 'default'
     self.name = name
+    self.profile = profile or AppConfig.DecodingProfile
     self.work_duration = work_duration
     self.dummy_threshold = dummy_threshold
     self.time = time if time is not None else datetime.utcnow()
 
     self.tc_worker: Optional[TranscribeWorker] = None
     self.tl_worker: Optional[TranslateWorker] = None
+    self.database: Optional[SessionDatabase] = None
+    self.writer: Optional[TranscriptWriter] = None
     self.provider_set = set()
     self.provider: Optional[tuple] = None
     self.dummy_work_count = 0
     self.last_result: Optional[TranscriptionResult] = None
     self.provider_task: Optional[asyncio.Task] = None
+    self.translation_task: Optional[asyncio.Task] = None
+    self.scheduler = TranscriptionScheduler(idle_interval=work_duration)
+    self.backpressure = BackpressurePolicy(
+      AppConfig.BackpressureStrategy, AppConfig.MaxTranscriptionLag)
     
-    self.lock = asyncio.Lock()
+    self.lock = asyncio.Lock()  # transcription passes, held during inference
+    self.ingest_lock = asyncio.Lock()  # audio intake, never held during inference
     
 
   async def init(self):
     if self.tc_worker is None:
-      self.tc_worker = WhisperWorker('medium')
+      options = dict(
+        vad=EnergyVAD() if AppConfig.VoiceActivityGate else None,
+        streaming=AppConfig.StreamingTranscription,
+        language=LanguageTracker(
+          AppConfig.AllowedLanguages if AppConfig.RestrictLanguage else None,
+          int(AppConfig.LanguageRedetectInterval * 1000),
+        ) if AppConfig.LanguagePinning else None,
+        profile=DECODING_PROFILES[self.profile],
+        audio_ctx_bucket=AppConfig.AudioContextBucket,
+        batching=AppConfig.BatchInference,
+        mel_cache=AppConfig.MelCache,
+        buffer_duration=AppConfig.AudioBufferLimit,
+        quantize=AppConfig.ModelQuantization,
+      )
+      if AppConfig.PartialModel:
+        self.tc_worker = WhisperCascadeWorker(
+          AppConfig.PartialModel, AppConfig.TranscriptionModel, **options)
+      elif AppConfig.TranscriptionProcess:
+        self.tc_worker = WhisperProcessWorker(
+          AppConfig.TranscriptionModel, num_threads=AppConfig.TranscriptionThreads, **options)
+      else:
+        self.tc_worker = WhisperWorker(AppConfig.TranscriptionModel, **options)
     if self.tl_worker is None:
       self.tl_worker = DeepLWorker(AppConfig.DeepLAuthKey, AppConfig.DeepLFreePlan)
       
-    initialize_db(self.session)
+    if self.database is None:
+      self.database = await session_databases.acquire(self.session)
+    if self.writer is None:
+      self.writer = TranscriptWriter(
+        self.database,
+        self.session,
+        AppConfig.TranscriptFlushBatch,
+        AppConfig.TranscriptFlushInterval,
+        AppConfig.TranscriptJournalLimit,
+      )
+      self.writer.start()
     await self.tc_worker.init_model()
     self.dummy_work_count = 0
 
   async def close(self):
-    await self.tc_worker.close_model()
-    del self.tc_worker
-    self.tc_worker = None
+    if self.writer is not None:
+      await self.writer.close()
+      self.writer = None
+    if self.database is not None:
+      # not while an export is reading the database
+      if AppConfig.MeetingArchive and session_databases.users(self.session) == 1 \
+          and await archive_records(self.database, AppConfig.TranslationTarget):
+        session_databases.compact(self.database)  # releases it when done
+      else:
+        session_databases.release(self.database)
+      self.database = None
+    if self.tc_worker is not None:
+      await self.tc_worker.close_model()
+      self.tc_worker = None
 
   # provider
 
@@ -84,47 +143,77 @@ class MeetingHandler:
     return self.provider == provider
 
 
-  def start_providing(self):
+  def _start_task(self, name: str, coro):
     
-    in_transcrition = False
+    def _task_done(task: asyncio.Task):
+      if getattr(self, name) is task:
+        setattr(self, name, None)
+      if not task.cancelled() and task.exception() is not None:
+        raise task.exception()
     
-    async def _task():
-      nonlocal in_transcrition
+    task = asyncio.create_task(coro)
+    task.add_done_callback(_task_done)
+    setattr(self, name, task)
+
+  def start_providing(self):
+    
+    async def _transcribe():
       try:
         while self.tc_worker is not None:
+          await asyncio.sleep(self.scheduler.poll_interval)
+          if self.tc_worker is None:
+            break
+          pending = self.tc_worker.pending_duration()
+          if not self.scheduler.due(pending):
+            continue
           
+          self.scheduler.begin()
+          time_start = time.monotonic()
           await self.run_transcription_once()
-          await asyncio.sleep(self.work_duration * 0.2)
-          
-          await self.run_translation_once()
-          await asyncio.sleep(self.work_duration * 0.8)
+          self.scheduler.record(time.monotonic() - time_start, pending)
           
       except asyncio.CancelledError as e:
         print('Task Cancelled.')
         return False
       return True
     
-    def _task_done(_):
-      e = self.provider_task.exception()
-      del self.provider_task
-      self.provider_task = None
-      if e is not None and not isinstance(e, asyncio.CancelledError):
-        raise e
+    async def _translate():
+      try:
+        while self.tc_worker is not None:
+          await self.run_translation_once()
+          await asyncio.sleep(self.work_duration)
+      except asyncio.CancelledError as e:
+        return False
+      return True
     
-    self.provider_task = asyncio.create_task(_task())
-    self.provider_task.add_done_callback(_task_done)
+    self._start_task('provider_task', _transcribe())
+    self._start_task('translation_task', _translate())
     
   def stop_providing(self):
-    if not self.provider_task:
-      return
-    self.provider_task.cancel()
+    for task in (self.provider_task, self.translation_task):
+      if task:
+        task.cancel()
     self.provider_task = None
+    self.translation_task = None
 
 
-  async def enqueue_audio_data(self, time: int, data: NDArray[np.float32]):
-    async with self.lock:
-      await self.tc_worker.enqueue_chunk(time, data)
+  async def enqueue_audio_chunks(self, chunks: Iterable[Tuple[int, NDArray[np.float32]]]):
+    async with self.ingest_lock:
+      await self.tc_worker.enqueue_chunks(chunks)
       self.dummy_work_count = 0
+      changed = await self.backpressure.apply(self.tc_worker)
+    if changed:
+      await self.backpressure.notify()
+
+  def get_stats(self) -> dict:
+    return dict(
+      session=self.session,
+      overflow=self.tc_worker.overflow_duration() if self.tc_worker else 0,
+      context_fallbacks=self.tc_worker.context_fallbacks() if self.tc_worker else 0,
+      backpressure=self.backpressure.get_stats(),
+      writer=self.writer.get_stats() if self.writer else None,
+      scheduler=dict(window=self.scheduler.window, pass_time=self.scheduler.pass_time, rtf=self.scheduler.rtf),
+    )
     
     # if not self.provider_task:
     #   self.start_providing()
@@ -156,7 +245,7 @@ class MeetingHandler:
         await self.tc_worker.discard_chunks()
         
       if DEBUG_MODE and res:
-        print('W', flag1, self.tc_worker.last_element[0] if self.tc_worker.last_element else '-')
+        print('W', flag1, self.tc_worker.timeline.start_time if self.tc_worker.timeline.size else '-')
         if self.last_result:
           print('L', self.last_result)
         for _ in res:
@@ -164,17 +253,24 @@ class MeetingHandler:
         print()
         
       for result_raw in res:
-        if not result_raw.partial:
-          # store the result into db
-          await add_record(
-            self.session, 
-            datetime.utcfromtimestamp(result_raw.start / 1000), 
-            result_raw.text,
-            result_raw.lang,
-          )
-        else:
+        if result_raw.partial:
           self.last_result = result_raw
-        await self.callback(result_raw, None)
+
+      # throttled providers stop sending, so the lag is only seen to fall here
+      async with self.ingest_lock:
+        changed = await self.backpressure.apply(self.tc_worker)
+    if changed:
+      await self.backpressure.notify()
+
+    # the database is written by the writer task, not under the ingest lock
+    for result_raw in res:
+      if not result_raw.partial:
+        await self.writer.add(
+          datetime.utcfromtimestamp(result_raw.start / 1000),
+          result_raw.text,
+          result_raw.lang,
+        )
+      await self.callback(result_raw, None)
         
   # translation
         
@@ -188,6 +284,7 @@ class MeetingHandler:
         
   async def run_translation_once(self):
     await update_translations(
+      self.database,
       self.handle_translation,
       self.session,
       datetime.utcfromtimestamp(1),
@@ -1,30 +1,37 @@
 import asyncio
 import os
+import re
+import time
+import logging
 import peewee as pw
 import peewee_async as pwa
+from collections import OrderedDict
 from datetime import datetime, timezone
 from dataclasses import dataclass
+from urllib.parse import quote
 
-from typing import Optional, Callable, Iterable
+from typing import Optional, Callable, Iterable, List, Dict, Any, Type, Tuple, Set
 
 from constants import Codes
+from config import AppConfig
 from utils.sqlite import AsyncSqliteDatabase
 from utils.object import format_time
 
-db = AsyncSqliteDatabase(None)
-objects = pwa.Manager(db)
+from meeting.search import search_index
+from meeting.archive import ArchiveReader, ArchiveWriter
+
+default_logger = logging.getLogger(__name__)
 
 _MEETING_SESSION_DIR = './meetings/'
 os.makedirs(_MEETING_SESSION_DIR, exist_ok=True)
 
+_SESSION_NAME = re.compile(r'[\w-]+')
+
 
-def initialize_db(target: str = 'default'):
-  db.init(os.path.join(_MEETING_SESSION_DIR, target + '.sqlite'))
-  db.set_allow_sync(False)
-  with db.allow_sync():
-    db.connect()
-    db.create_tables([MeetingRecord], safe=True)
-    db.close()
+def valid_session(session: str) -> bool:
+  '''Session names are file names, without dots or path separators.
+  '''
+  return _SESSION_NAME.fullmatch(session) is not None
 
 
 class MeetingRecord(pw.Model):
@@ -38,51 +45,385 @@ class MeetingRecord(pw.Model):
   translate4 = pw.TextField(default='')
 
   class Meta:
-    database = db
+    indexes = (
+        (('session', 'time'), False),
+    )
+
+
+class TranslationProgress(pw.Model):
+  '''Last record translated to `lang`, records are only added after it.
+  '''
+  session = pw.CharField(max_length=36, default='')
+  lang = pw.CharField(max_length=8, default='')
+  last_id = pw.IntegerField(default=0)
+
+  class Meta:
+    indexes = (
+        (('session', 'lang'), True),
+    )
+
+
+def _bind(model: Type[pw.Model], database: pw.Database) -> Type[pw.Model]:
+  # a subclass per database, so sessions never rebind a shared model
+  meta = type('Meta', (), {'database': database, 'table_name': model._meta.table_name})
+  return type(model.__name__, (model,), {'Meta': meta, '__module__': model.__module__})
+
+
+class SessionDatabase:
+  '''The database file of one meeting session, with models bound to it.
+
+  Writes go through `writes`, a FIFO lock, so the writers of a session
+  queue up in the event loop instead of contending for SQLite's write lock.
+  A `readonly` handle neither creates the file nor writes to it.
+  '''
+
+  def __init__(self, session: str, path: str, readonly: bool = False):
+    self.session = session
+    self.path = path
+    self.readonly = readonly
+    self.archive_path = os.path.splitext(path)[0] + '.archive'
+    self.reader: Optional[ArchiveReader] = None
+    if readonly:
+      self.db = AsyncSqliteDatabase(f'file:{quote(path)}?mode=ro', uri=True)
+    else:
+      self.db = AsyncSqliteDatabase(path)
+    self.objects = pwa.Manager(self.db)
+    self.MeetingRecord = _bind(MeetingRecord, self.db)
+    self.TranslationProgress = _bind(TranslationProgress, self.db)
+    self.writes = asyncio.Lock()
+    self.users = 0
+    self.last_used = time.monotonic()
+
+  def open(self):
+    self.db.set_allow_sync(False)
+    if self.readonly:
+      return
+    with self.db.allow_sync():
+      self.db.connect()
+      self.db.create_tables([self.MeetingRecord, self.TranslationProgress], safe=True)
+      self.db.close()
+
+  def archive(self) -> Optional[ArchiveReader]:
+    '''Reader of the archived records of this session, if any.
+    '''
+    try:
+      size = os.path.getsize(self.archive_path)
+    except OSError:
+      return None
+    if self.reader is None or self.reader.size != size:
+      # a reader still in use keeps its own map of the old file
+      self.reader = ArchiveReader(self.archive_path)
+    return self.reader
+
+  async def close(self):
+    self.reader = None
+    await self.objects.close()
+
+
+class SessionDatabaseManager:
+  '''Open session databases, most recently used last.
+
+  Handles are shared by everyone acquiring the same session in the same
+  mode. A released handle is closed after `idle_timeout` seconds without
+  users, or earlier when more than `capacity` handles are open.
+  '''
+
+  def __init__(
+      self,
+      capacity: int = 8,
+      idle_timeout: float = 300,  # in seconds
+      directory: str = _MEETING_SESSION_DIR,
+      logger: Optional[logging.Logger] = None,
+  ):
+    self.capacity = max(capacity, 1)
+    self.idle_timeout = idle_timeout
+    self.directory = directory
+    self.logger = logger or default_logger
+    self.handles: OrderedDict[Tuple[str, bool], SessionDatabase] = OrderedDict()
+    self.timer: Optional[asyncio.TimerHandle] = None
+    self.tasks: Set[asyncio.Task] = set()
+
+  def _path(self, session: str) -> str:
+    if not valid_session(session):
+      raise ValueError(f'Invalid session name: {session!r}')
+    return os.path.join(self.directory, session + '.sqlite')
+
+  def exists(self, session: str) -> bool:
+    '''Whether `session` has a database or an archive.
+    '''
+    path = self._path(session)
+    return os.path.exists(path) or os.path.exists(os.path.splitext(path)[0] + '.archive')
+
+  def users(self, session: str) -> int:
+    return sum(h.users for (s, _), h in self.handles.items() if s == session)
+
+  async def acquire(self, session: str = 'default', readonly: bool = False) -> SessionDatabase:
+    '''Raises ValueError if `session` is not a valid session name.
+    '''
+    key = session, readonly
+    handle = self.handles.get(key)
+    if handle is None:
+      handle = SessionDatabase(session, self._path(session), readonly)
+      handle.open()
+      self.handles[key] = handle
+    self.handles.move_to_end(key)
+    handle.users += 1
+    handle.last_used = time.monotonic()
+    await self.close_idle()
+    return handle
+
+  def archived(self, session: str) -> Optional[ArchiveReader]:
+    '''Reader of the archive of `session` if it holds every record, that is
+    if the database was not written since it was archived, which is told
+    from the file times without opening the database. Close it after use.
+    '''
+    path = self._path(session)
+    archive_path = os.path.splitext(path)[0] + '.archive'
+    try:
+      archived = os.stat(archive_path).st_mtime_ns
+    except OSError:
+      return None
+    for written in (path, path + '-wal'):
+      try:
+        stat = os.stat(written)
+      except OSError:
+        continue
+      # readers leave an empty log behind
+      if stat.st_size > 0 and stat.st_mtime_ns > archived:
+        return None
+    return ArchiveReader(archive_path)
+
+  def release(self, handle: SessionDatabase):
+    handle.users = max(handle.users - 1, 0)
+    handle.last_used = time.monotonic()
+    if handle.users == 0:
+      self._schedule()
+
+  def compact(self, handle: SessionDatabase):
+    '''Release `handle` once `compact_database` is done with it, which runs
+    in the background.
+    '''
+    task = asyncio.ensure_future(self._compact(handle))
+    self.tasks.add(task)
+    task.add_done_callback(self.tasks.discard)
+
+  async def _compact(self, handle: SessionDatabase):
+    try:
+      await compact_database(handle)
+    except Exception as e:
+      self.logger.warning(f'Failed to compact the database of session {handle.session}: {e!r}')
+    finally:
+      self.release(handle)
+
+  def _schedule(self):
+    # one timer, for the handle that expires first
+    if self.timer is not None:
+      return
+    idle = [h.last_used for h in self.handles.values() if h.users == 0]
+    if idle:
+      delay = max(min(idle) + self.idle_timeout - time.monotonic(), 0)
+      self.timer = asyncio.get_running_loop().call_later(
+          delay, lambda: asyncio.ensure_future(self._expire()))
+
+  async def _expire(self):
+    self.timer = None
+    await self.close_idle()
+    self._schedule()
+
+  async def close_idle(self):
+    '''Close unused handles that timed out or do not fit the cache.
+    '''
+    now = time.monotonic()
+    excess = len(self.handles) - self.capacity
+    for key, handle in list(self.handles.items()):
+      if handle.users > 0:
+        continue
+      if excess > 0 or now - handle.last_used >= self.idle_timeout:
+        del self.handles[key]
+        excess -= 1
+        try:
+          await handle.close()
+        except Exception as e:
+          self.logger.warning(f'Failed to close the database of session {handle.session}: {e!r}')
+
+  async def close_all(self):
+    if self.tasks:
+      await asyncio.gather(*self.tasks, return_exceptions=True)
+    if self.timer is not None:
+      self.timer.cancel()
+      self.timer = None
+    handles, self.handles = list(self.handles.values()), OrderedDict()
+    for handle in handles:
+      await handle.close()
+
+
+session_databases = SessionDatabaseManager(
+    AppConfig.SessionDatabaseCache,
+    AppConfig.SessionDatabaseIdleTimeout,
+)
 
 
 _TRANSLATE_ORDER = {
-    'en': (1, MeetingRecord.translate1),
-    'jp': (2, MeetingRecord.translate2),
-    'zh': (3, MeetingRecord.translate3),
+    'en': (1, 'translate1'),
+    'jp': (2, 'translate2'),
+    'zh': (3, 'translate3'),
 }
 
 
+def record_fields(
+    session: str,
+    time: datetime,
+    text: str,
+    lang: Optional[str] = None
+) -> Dict[str, Any]:
+  i, _ = _TRANSLATE_ORDER.get(lang, (-1, None))
+  kwargs = {} if i < 0 else {f'translate{i}': text}
+  return dict(
+      session=session,
+      time=time,
+      text=text,
+      lang=lang or '',
+      **kwargs
+  )
+
+
 async def add_record(
+    database: SessionDatabase,
     session: str,
     time: datetime,
     text: str,
     lang: Optional[str] = None
 ):
   try:
-    i, _ = _TRANSLATE_ORDER.get(lang, (-1, None))
-    kwargs = {} if i < 0 else {f'translate{i}': text}
-    await objects.create(
-        MeetingRecord,
-        session=session,
-        time=time,
-        text=text,
-        lang=lang or '',
-        **kwargs
-    )
+    async with database.writes:
+      record = await database.objects.create(
+          database.MeetingRecord, **record_fields(session, time, text, lang))
   except pw.IntegrityError:
     return Codes.ERR_SESSION_DB
+  await search_index.add([_index_row(session, record.id, time, lang or '', text)])
+
+
+def _index_row(session: str, id: int, time: datetime, lang: str, text: str, source: bool = True) -> Dict[str, Any]:
+  return dict(session=session, record=id, time=time, lang=lang, text=text, source=int(source))
+
+
+_INSERT_CHUNK = 100  # rows per statement, within SQLite's variable limit
+
+
+async def add_records(database: SessionDatabase, rows: List[Dict[str, Any]]):
+  '''Insert the rows made by `record_fields` in a single transaction.
+  '''
+  objects, Record = database.objects, database.MeetingRecord
+  ids = []
+  try:
+    async with database.writes, objects.atomic():
+      for i in range(0, len(rows), _INSERT_CHUNK):
+        chunk = rows[i:i + _INSERT_CHUNK]
+        # the rows of one statement get consecutive ids under the write lock
+        last_id = await objects.execute(Record.insert_many(chunk))
+        ids.extend(range(last_id - len(chunk) + 1, last_id + 1))
+  except pw.IntegrityError:
+    return Codes.ERR_SESSION_DB
+  await search_index.add([
+      _index_row(row['session'], id, row['time'], row['lang'], row['text'])
+      for id, row in zip(ids, rows)
+  ])
 
 
 async def fetch_records(
+    database: SessionDatabase,
     session: str,
     time_start: datetime,
     time_end: Optional[datetime] = None,
     lang: Optional[str] = None,
 ):
-  where_clause = (MeetingRecord.session == session) & \
-      (MeetingRecord.time >= time_start)
+  Record = database.MeetingRecord
+  where_clause = (Record.session == session) & \
+      (Record.time >= time_start)
   if time_end is not None:
-    where_clause = where_clause & (MeetingRecord.time <= time_end)
+    where_clause = where_clause & (Record.time <= time_end)
   if lang is not None and lang != '':
-    where_clause = where_clause & (MeetingRecord.lang.startswith(lang))
-  results = await objects.execute(MeetingRecord.select().where(where_clause))
-  return results
+    where_clause = where_clause & (Record.lang.startswith(lang))
+  reader = database.archive()
+  if reader is None:
+    return await database.objects.execute(Record.select().where(where_clause))
+
+  archived = [
+      Record(**row) for row in reader.read(time_start, time_end, lang)
+      if row['session'] == session
+  ]
+  where_clause = where_clause & (Record.id > reader.through)
+  return archived + list(await database.objects.execute(Record.select().where(where_clause)))
+
+
+_ARCHIVE_PAGE = 1000  # records read from the database at once
+
+
+async def archive_records(database: SessionDatabase, language: Optional[str] = None) -> int:
+  '''Move the records of `database` to its archive file. With `language`,
+  only the records the translation to it got through are moved, since it
+  reads the database. The last record moved stays, so that ids keep
+  increasing if the session is reopened. Returns the number of records
+  archived. Compact the database afterwards with `compact_database`.
+  '''
+  objects, Record, Progress = database.objects, database.MeetingRecord, database.TranslationProgress
+  reader = database.archive()
+  through = reader.through if reader is not None else 0
+  last_id = None
+  if language in _TRANSLATE_ORDER:
+    try:
+      progress = await objects.get(Progress, session=database.session, lang=language)
+      last_id = progress.last_id
+    except Progress.DoesNotExist:
+      return 0
+    if last_id <= through:
+      return 0
+  filled = {lang: column for lang, (_, column) in _TRANSLATE_ORDER.items()}
+  columns = ['id', 'session', 'time', 'lang', 'text', 'translate1', 'translate2', 'translate3', 'translate4']
+
+  loop = asyncio.get_running_loop()
+  async with database.writes:
+    writer = await loop.run_in_executor(
+        None, ArchiveWriter, database.archive_path, database.session, filled)
+    count, after = 0, None
+    try:
+      while True:
+        where_clause = Record.id > through
+        if last_id is not None:
+          where_clause = where_clause & (Record.id <= last_id)
+        if after is not None:
+          where_clause = where_clause & ((Record.time > after.time) | (
+              (Record.time == after.time) & (Record.id > after.id)))
+        query = Record.select().where(where_clause).order_by(Record.time, Record.id).limit(_ARCHIVE_PAGE)
+        page = list(await objects.execute(query))
+        if not page:
+          break
+        rows = [{c: getattr(r, c) for c in columns} for r in page]
+        await loop.run_in_executor(None, writer.add, rows)
+        count += len(page)
+        after = page[-1]
+      if count == 0:
+        await loop.run_in_executor(None, writer.abort)
+        return 0
+      await loop.run_in_executor(None, writer.close)
+    except BaseException:
+      await loop.run_in_executor(None, writer.abort)
+      raise
+
+    await objects.execute(Record.delete().where(Record.id < writer.footer['through']))
+  return count
+
+
+async def compact_database(database: SessionDatabase):
+  '''Give the space of archived records back to the file system.
+  '''
+  objects, Record = database.objects, database.MeetingRecord
+  async with database.writes:
+    await objects.execute(Record.raw('VACUUM'))
+    # with WAL the file only shrinks once the log is checkpointed
+    await objects.execute(Record.raw('PRAGMA wal_checkpoint(TRUNCATE)'))
+    # newer than the compacted database, see SessionDatabaseManager.archived
+    os.utime(database.archive_path)
 
 # translation related
 
@@ -98,32 +439,45 @@ class TranslationResult:
 
 
 async def update_translations(
+    database: SessionDatabase,
     f_translate: Callable[[str, str, str], asyncio.Task[str]],  # src, tgt, txt_src -> txt_tgt
     session_value: Optional[str],
     time_threshold: datetime,
     language: str,
     f_callback: Optional[Callable[[TranslationResult], asyncio.Task]] = None,
+    batch_size: int = 64,
 ):
   lang_id, lang_key = _TRANSLATE_ORDER.get(language, (-1, None))
   if not lang_key:
     return False
 
-  lang_objkey = f'translate{lang_id}'
+  objects, Record, Progress = database.objects, database.MeetingRecord, database.TranslationProgress
+  async with database.writes:
+    progress, _ = await objects.get_or_create(
+        Progress, session=session_value or '', lang=language)
 
-  where_clause = (MeetingRecord.time > time_threshold) & (
-      MeetingRecord.lang != language) & (lang_key == '')
+  # records only get ids after the ones before them, so everything past
+  # the mark is new; same language records are filled at insert
+  where_clause = Record.id > progress.last_id
   if session_value:
-    where_clause = where_clause & (MeetingRecord.session == session_value)
-
-  records: Iterable[MeetingRecord] = await objects.execute(MeetingRecord.select().where(where_clause))
+    where_clause = where_clause & (Record.session == session_value)
+  query = Record.select().where(where_clause).order_by(Record.id).limit(batch_size)
+  records: Iterable[MeetingRecord] = await objects.execute(query)
 
   for record in records:
-    translated_text = await f_translate(record.lang, language, record.text)
-    setattr(record, lang_objkey, translated_text)
-    if f_callback:
+    translated_text = None
+    if record.time > time_threshold and record.lang != language and getattr(record, lang_key) == '':
+      translated_text = await f_translate(record.lang, language, record.text)
+    progress.last_id = record.id
+    async with database.writes, objects.atomic():
+      if translated_text is not None:
+        await objects.execute(Record.update({lang_key: translated_text}).where(Record.id == record.id))
+      await objects.update(progress, only=[Progress.last_id])
+    if translated_text is not None:
+      await search_index.add([_index_row(record.session, record.id, record.time, language, translated_text, False)])
+    if translated_text is not None and f_callback:
       ts = int(record.time.replace(tzinfo=timezone.utc).timestamp() * 1000)
       res = TranslationResult(ts, record.text, record.lang, translated_text)
       await f_callback(res)
-    await objects.update(record)
 
   return True
@@ -0,0 +1,61 @@
+import time
+from typing import Optional
+
+
+class TranscriptionScheduler:
+  '''Decides when the next transcription pass runs.
+
+  A pass is due when enough new audio has been buffered, when buffered
+  audio has waited for `max_latency`, or, to keep silence detection going,
+  when nothing has run for `idle_interval`. The amount of new audio that
+  triggers a pass follows the measured pass time, so that passes take at
+  most `target_load` of the wall time.
+  '''
+
+  def __init__(
+      self,
+      min_window: float = 0.3,  # in seconds
+      max_window: float = 5,  # in seconds
+      max_latency: float = 1.5,  # in seconds
+      idle_interval: float = 0.7,  # in seconds
+      poll_interval: float = 0.05,  # in seconds
+      target_load: float = 0.8,
+      smoothing: float = 0.3,
+  ):
+    self.min_window = min_window
+    self.max_window = max_window
+    self.max_latency = max_latency
+    self.idle_interval = idle_interval
+    self.poll_interval = poll_interval
+    self.target_load = target_load
+    self.smoothing = smoothing
+
+    self.window = min_window
+    self.pass_time: Optional[float] = None  # moving average, in seconds
+    self.rtf: Optional[float] = None  # moving average of pass time / new audio
+    self.last_run = time.monotonic()
+
+  def due(self, pending: float) -> bool:
+    '''Whether a pass should run with `pending` seconds of new audio.
+    '''
+    waited = time.monotonic() - self.last_run
+    return pending >= self.window or \
+        (pending > 0 and waited >= self.max_latency) or \
+        waited >= self.idle_interval
+
+  def begin(self):
+    self.last_run = time.monotonic()
+
+  def record(self, elapsed: float, audio: float):
+    '''Record a pass over `audio` seconds of new audio that took `elapsed`
+    seconds, and adapt the trigger window.
+    '''
+    self.last_run = time.monotonic()
+    if audio <= 0:
+      return
+    a = self.smoothing
+    rtf = elapsed / audio
+    self.rtf = rtf if self.rtf is None else (1 - a) * self.rtf + a * rtf
+    self.pass_time = elapsed if self.pass_time is None else \
+        (1 - a) * self.pass_time + a * elapsed
+    self.window = min(max(self.pass_time / self.target_load, self.min_window), self.max_window)
@@ -0,0 +1,225 @@
+from typing import Optional, List, Dict, Any, Iterable, Tuple
+
+import re
+import os
+import logging
+import peewee_async as pwa
+from datetime import datetime, timezone
+from playhouse.sqlite_ext import FTS5Model, SearchField
+
+from utils.sqlite import AsyncSqliteDatabase
+
+default_logger = logging.getLogger(__name__)
+
+_SEARCH_INDEX_PATH = './meetings/.search.sqlite'
+
+# scripts written without spaces, indexed as overlapping bigrams
+_CJK_RUN = re.compile('[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff66-\uff9f]+')
+_TERM = re.compile(r'\w+')
+_SNIPPET_CONTEXT = 40  # characters around the first match
+
+
+def _to_ms(time: datetime) -> int:
+  return int(time.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def _bigrams(run: str) -> str:
+  if len(run) == 1:
+    return run
+  return ' '.join(run[i:i + 2] for i in range(len(run) - 1))
+
+
+def _index_run(run: str) -> str:
+  # the last character only ends a bigram, so it is also indexed on its own
+  # for a one-character prefix query to find it
+  if len(run) == 1:
+    return run
+  return f'{_bigrams(run)} {run[-1]}'
+
+
+def index_terms(text: str) -> str:
+  '''`text` with CJK runs split into bigrams, which unicode61 would
+  otherwise index as one token per run.
+  '''
+  return _CJK_RUN.sub(lambda m: f' {_index_run(m.group())} ', text)
+
+
+def _quote(phrase: str) -> str:
+  return '"' + phrase.replace('"', '""') + '"'
+
+
+def match_query(query: str) -> Tuple[str, List[str]]:
+  '''FTS5 query matching every word of `query`, and the words to highlight.
+  Words are quoted, so operators typed by users are searched literally.
+  '''
+  terms, words = [], []
+  for word in _TERM.findall(query):
+    for part in re.split(f'({_CJK_RUN.pattern})', word):
+      if not part:
+        continue
+      words.append(part)
+      if _CJK_RUN.fullmatch(part) and len(part) == 1:
+        terms.append(_quote(part) + '*')  # the bigrams starting with it
+      elif _CJK_RUN.fullmatch(part):
+        terms.append(_quote(_bigrams(part)))  # adjacent bigrams
+      else:
+        terms.append(_quote(part) + '*')
+  return ' '.join(terms), words
+
+
+def snippet(text: str, words: Iterable[str]) -> Tuple[str, List[Tuple[int, int]]]:
+  '''Part of `text` around the first match, and the [start, end) ranges of
+  the matches in it.
+  '''
+  pattern = re.compile('|'.join(re.escape(w) for w in words), re.IGNORECASE) if words else None
+  spans = [m.span() for m in pattern.finditer(text)] if pattern else []
+  if not spans:
+    return text[:2 * _SNIPPET_CONTEXT], []
+  lo = max(spans[0][0] - _SNIPPET_CONTEXT, 0)
+  hi = min(spans[0][1] + _SNIPPET_CONTEXT, len(text))
+  return text[lo:hi], [(s - lo, e - lo) for s, e in spans if s >= lo and e <= hi]
+
+
+class TranscriptIndex(FTS5Model):
+  '''One row per text of a record: the source, or one of its translations.
+  Only `terms` is indexed, the other columns are returned as stored.
+  '''
+  terms = SearchField()
+  text = SearchField(unindexed=True)
+  session = SearchField(unindexed=True)
+  record = SearchField(unindexed=True)  # id in the session database
+  time = SearchField(unindexed=True)  # in ms
+  lang = SearchField(unindexed=True)  # language of `text`
+  source = SearchField(unindexed=True)  # 1 for the source text, 0 for a translation
+
+  class Meta:
+    options = {'tokenize': 'unicode61 remove_diacritics 2'}
+
+
+class SearchIndex:
+  '''Full-text index of the transcripts and translations of every session,
+  in one database so that a search does not open each meeting. Rows are
+  only ever added, as records and translations are written.
+  '''
+
+  def __init__(self, path: str = _SEARCH_INDEX_PATH, logger: Optional[logging.Logger] = None):
+    self.path = path
+    self.logger = logger or default_logger
+    self.db: Optional[AsyncSqliteDatabase] = None
+    self.objects: Optional[pwa.Manager] = None
+    self.Index = TranscriptIndex
+
+  def _open(self):
+    if self.db is not None:
+      return
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    db = AsyncSqliteDatabase(self.path)
+    self.Index = type('TranscriptIndex', (TranscriptIndex,), {
+        'Meta': type('Meta', (), {'database': db, 'table_name': TranscriptIndex._meta.table_name}),
+        '__module__': __name__,
+    })
+    db.set_allow_sync(False)
+    with db.allow_sync():
+      db.connect()
+      db.create_tables([self.Index], safe=True)
+      db.close()
+    self.db = db
+    self.objects = pwa.Manager(db)
+
+  async def add(self, rows: List[Dict[str, Any]]):
+    '''Index rows of `session`, `record`, `time`, `lang`, `text`, `source`.
+    Failures are logged, the records are written anyway.
+    '''
+    rows = [r for r in rows if r['text']]
+    if not rows:
+      return
+    try:
+      self._open()
+      for row in rows:
+        row['terms'] = index_terms(row['text'])
+        if isinstance(row['time'], datetime):
+          row['time'] = _to_ms(row['time'])
+      async with self.objects.atomic():
+        for i in range(0, len(rows), 100):
+          await self.objects.execute(self.Index.insert_many(rows[i:i + 100]))
+    except Exception as e:
+      self.logger.warning(f'Failed to index {len(rows)} transcript texts: {e!r}')
+
+  async def search(
+      self,
+      query: str,
+      session: Optional[str] = None,
+      time_start: Optional[datetime] = None,
+      time_end: Optional[datetime] = None,
+      lang: Optional[str] = None,
+      limit: int = 20,
+      pending: Iterable[Any] = (),
+  ) -> List[Dict[str, Any]]:
+    '''Best matches first, with a snippet around the first match of each.
+    `pending` are records not indexed yet, from the writer of the live
+    meeting. Their matches come first, newest first, as they are not ranked.
+    '''
+    expression, words = match_query(query)
+    if not expression:
+      return []
+    results = []
+    for record in sorted(pending, key=lambda r: r.time, reverse=True):
+      if len(results) >= limit:
+        return results
+      if session and record.session != session or lang and record.lang != lang \
+          or time_start is not None and record.time < time_start \
+          or time_end is not None and record.time > time_end:
+        continue
+      text = record.text.lower()
+      if not all(word.lower() in text for word in words):
+        continue
+      text, highlights = snippet(record.text, words)
+      results.append(dict(
+          session=record.session,
+          id=record.id,
+          time=_to_ms(record.time),
+          lang=record.lang,
+          source=True,
+          snippet=text,
+          highlights=highlights,
+          score=None,
+      ))
+    self._open()
+    Index = self.Index
+    where_clause = Index.match(expression)
+    if session:
+      where_clause = where_clause & (Index.session == session)
+    if time_start is not None:
+      where_clause = where_clause & (Index.time >= _to_ms(time_start))
+    if time_end is not None:
+      where_clause = where_clause & (Index.time <= _to_ms(time_end))
+    if lang:
+      where_clause = where_clause & (Index.lang == lang)
+    query = Index.select(
+        Index.text, Index.session, Index.record, Index.time, Index.lang, Index.source,
+        Index.rank().alias('score'),
+    ).where(where_clause).order_by(Index.rank()).limit(limit - len(results))
+
+    seen = {(r['session'], r['id']) for r in results}
+    for row in await self.objects.execute(query):
+      if row.source and (row.session, row.record) in seen:
+        continue  # written after the snapshot of `pending`
+      text, highlights = snippet(row.text, words)
+      results.append(dict(
+          session=row.session,
+          id=row.record,
+          time=row.time,
+          lang=row.lang,
+          source=bool(row.source),
+          snippet=text,
+          highlights=highlights,
+          score=-row.score,  # bm25 is lower for better matches
+      ))
+    return results
+
+  async def close(self):
+    if self.objects is not None:
+      await self.objects.close()
+
+
+search_index = SearchIndex()
@@ -0,0 +1,157 @@
+from typing import Optional, List, Dict, Any, Tuple
+
+import time
+import asyncio
+import logging
+import peewee as pw
+from collections import deque
+from datetime import datetime
+
+from meeting.model import SessionDatabase, MeetingRecord, record_fields, add_records
+
+default_logger = logging.getLogger(__name__)
+
+
+class TranscriptWriter:
+  '''Group-commit stage between the transcription loop and the database.
+
+  Final segments are appended to an in-memory journal and written by a
+  background task, one transaction per batch, when `max_batch` rows are
+  pending or the oldest has waited `max_delay` seconds. Rows stay in the
+  journal until committed, and `snapshot` lets readers see them either
+  way. `add` only waits when `capacity` rows are pending, that is when the
+  disk is far behind.
+  '''
+
+  def __init__(
+      self,
+      database: SessionDatabase,
+      session: str,
+      max_batch: int = 64,
+      max_delay: float = 0.5,  # in seconds
+      capacity: int = 4096,
+      logger: Optional[logging.Logger] = None,
+  ):
+    self.database = database
+    self.session = session
+    self.max_batch = max(max_batch, 1)
+    self.max_delay = max_delay
+    self.capacity = max(capacity, self.max_batch)
+    self.logger = logger or default_logger
+
+    self.journal: deque[Dict[str, Any]] = deque()
+    self.oldest = 0.0  # monotonic time the oldest pending row was added
+    self.wakeup = asyncio.Event()
+    self.drained = asyncio.Event()
+    self.drained.set()
+    self.flush_lock = asyncio.Lock()
+    self.task: Optional[asyncio.Task] = None
+
+    self.written = 0
+    self.flushes = 0
+    self.failures = 0
+
+  def start(self):
+    if self.task is None:
+      self.task = asyncio.create_task(self._run())
+
+  async def close(self):
+    '''Stop the background task and write everything still pending.
+    '''
+    task, self.task = self.task, None
+    if task is not None:
+      task.cancel()
+      try:
+        await task
+      except asyncio.CancelledError:
+        pass
+    if not await self.drain():
+      self.logger.error(f'Dropped {len(self.journal)} transcript rows of session {self.session}.')
+      self.journal.clear()
+      self.drained.set()
+
+  async def add(self, time_start: datetime, text: str, lang: Optional[str] = None):
+    while len(self.journal) >= self.capacity:
+      self.drained.clear()
+      await self.drained.wait()
+    if not self.journal:
+      self.oldest = time.monotonic()
+      self.wakeup.set()  # start the max_delay countdown
+    self.journal.append(record_fields(self.session, time_start, text, lang))
+    if len(self.journal) >= self.max_batch:
+      self.wakeup.set()
+
+  async def _run(self):
+    while True:
+      if self.journal:
+        timeout = max(self.oldest + self.max_delay - time.monotonic(), 0)
+      else:
+        timeout = None
+      try:
+        await asyncio.wait_for(self.wakeup.wait(), timeout)
+      except asyncio.TimeoutError:
+        pass
+      self.wakeup.clear()
+      if not self.journal:
+        continue
+      if len(self.journal) < self.max_batch and time.monotonic() < self.oldest + self.max_delay:
+        continue  # woken by the first row, wait for the deadline
+      if not await self.flush():
+        # retry the same rows after a delay
+        self.oldest = time.monotonic()
+
+  async def flush(self) -> bool:
+    '''Commit up to `max_batch` pending rows. Returns False on failure.
+    '''
+    async with self.flush_lock:
+      rows = [self.journal[i] for i in range(min(len(self.journal), self.max_batch))]
+      if not rows:
+        return True
+      try:
+        err = await add_records(self.database, rows)
+      except Exception as e:
+        err = e
+      if err is not None:
+        self.failures += 1
+        self.logger.warning(f'Failed to write {len(rows)} transcript rows: {err!r}')
+        return False
+      for _ in rows:
+        self.journal.popleft()
+    self.written += len(rows)
+    self.flushes += 1
+    if self.journal:
+      self.oldest = time.monotonic()
+      if len(self.journal) >= self.max_batch:
+        self.wakeup.set()
+    if len(self.journal) < self.capacity:
+      self.drained.set()
+    return True
+
+  async def drain(self) -> bool:
+    '''Write every pending row. Returns False if a write failed.
+    '''
+    while self.journal:
+      if not await self.flush():
+        return False
+    return True
+
+  async def snapshot(self) -> Tuple[int, List[MeetingRecord]]:
+    '''The highest record id in the database, and the pending rows as
+    records with the ids they are going to be written with. Records above
+    that id, written in the meantime, are the pending ones.
+    '''
+    Record = self.database.MeetingRecord
+    # a flush in between would make rows show up twice or not at all
+    async with self.flush_lock:
+      last_id = await self.database.objects.scalar(Record.select(pw.fn.MAX(Record.id))) or 0
+      # the writer is the only one adding records, one id after the other
+      records = [Record(id=last_id + 1 + i, **row) for i, row in enumerate(self.journal)]
+    return last_id, records
+
+  def get_stats(self) -> Dict[str, Any]:
+    return dict(
+        pending=len(self.journal),
+        written=self.written,
+        flushes=self.flushes,
+        failures=self.failures,
+    )
@@ -1,4 +1,4 @@
-from typing import Any, Optional, Set, Callable, Tuple
+from typing import Any, Optional, Set, Callable, Tuple, List
 from numpy.typing import NDArray
 import dataclasses
 
@@ -6,6 +6,7 @@ import numpy as np
 import asyncio
 import struct
 import json
+import logging
 
 from fastapi import WebSocket
 from starlette.websockets import WebSocketState, WebSocketDisconnect
@@ -14,12 +15,16 @@ from user import User
 from user.auth import get_current_user_ws
 from constants import Token, Codes, getDescriptionWs
 from utils.web import EventBasedWebSocketHandler
+from utils.audio import SAMPLE_RATE, StreamResampler, create_decoder
 
 from meeting.handler import MeetingHandler
+from meeting.backpressure import BackpressurePolicy
 from meeting.model import TranslationResult
 
 from transcribe.worker import TranscriptionResult
 
+default_logger = logging.getLogger(__name__)
+
 _handler: Optional[MeetingHandler] = None
 _active_sockets: Set['ConsumerHandler'] = set()
 
@@ -56,6 +61,25 @@ async def send_transcription(
 
 _emnsw = getDescriptionWs(Codes.ERR_MEETING_NOT_STARTED)
 _eauth = getDescriptionWs(Codes.ERR_AUTH_FAILED)
+_eformat = getDescriptionWs(Codes.ERR_UNSUPPORTED_FORMAT)
+
+# first byte of binary provider messages
+FRAME_LEGACY = 0x00  # no type byte: the 8-byte timestamp below 2^56 starts right away
+FRAME_AUDIO = 0x01  # 8-byte big endian timestamp in ms, then audio
+FRAME_CONTROL = 0x02  # json
+
+_TIMESTAMP = struct.Struct('>Q')
+
+# control codes sent to providers
+_THROTTLE = 2
+_RESUME = 3
+
+_MIN_RATE = 8000
+_MAX_RATE = 192000
+_MAX_CHANNELS = 8
+
+_ONE_MS_SAMPLE = SAMPLE_RATE // 1000
+_RESYNC_MAX = 100  # ms a resampled stream may drift from the client timestamps
 
 
 def _j(x: bytes):
@@ -74,8 +98,8 @@ def float32_to_int16(audio_data_raw: bytes) -> bytes:
 
 def int16_endian_cvrt(big_endian_array: bytes, le2be: bool = False) -> bytes:
   big_endian_array = np.frombuffer(
-      big_endian_array, dtype=np.dtype('<f2' if le2be else '>f2'))
-  little_endian_array = big_endian_array.astype('>f2' if le2be else '<f2')
+      big_endian_array, dtype=np.dtype('<i2' if le2be else '>i2'))
+  little_endian_array = big_endian_array.astype('>i2' if le2be else '<i2')
   little_endian_buffer = little_endian_array.tobytes()
   return little_endian_buffer
 
@@ -118,24 +142,31 @@ class ConsumerHandler(EventBasedWebSocketHandler):
 
 class ProviderHandler(EventBasedWebSocketHandler):
   
-  def __init__(self, websocket: WebSocket, token: str, format: str):
+  def __init__(self, websocket: WebSocket, token: str, format: str, rate: int = SAMPLE_RATE, channels: int = 1):
     super().__init__(websocket)
     self.token = token
     self.format = format
+    self.rate = rate
+    self.channels = channels
     self.user: Optional[User] = None
     self.addr: Tuple[str, int] = ('', 0)
     
+    # prepare audio handler, None if the format is not supported
+    self.decoder = create_decoder(format)
+    self.resampler: Optional[StreamResampler] = None
+    self.position: Optional[int] = None  # sample index of the next resampled sample
+    self.carry = np.zeros((0,), dtype=np.float32)  # resampled samples short of a ms
+    if self.decoder is not None and not self.decoder.fixed_rate:
+      if not (_MIN_RATE <= rate <= _MAX_RATE and 1 <= channels <= _MAX_CHANNELS):
+        self.decoder = None
+      elif rate != SAMPLE_RATE or channels != 1:
+        self.resampler = StreamResampler(rate, channels)
     
-    # prepare audio handler
-    audio_handler: Callable[[bytes], NDArray] = lambda x: np.frombuffer(x, dtype=np.float32)
-    # TODO handle int16 data if necessary
-    
-    # if format == 'int16be' and sys.byteorder != 'big':
-    #   audio_handler = int16_endian_cvrt
-    # elif (format == 'int16' or format == 'int16le') and sys.byteorder == 'big':
-    #   def audio_handler(x): return int16_endian_cvrt(x, True)
-      
-    self.audio_handler = audio_handler
+    # frames received in a burst, enqueued together
+    self.pending: List[Tuple[int, memoryview]] = []
+    self.flush_task: Optional[asyncio.Task] = None
+    self.backpressure: Optional[BackpressurePolicy] = None
+    self.throttled = False
     
   
   async def on_connect(self, *args, **kwargs) -> None:
@@ -147,39 +178,117 @@ class ProviderHandler(EventBasedWebSocketHandler):
     if _handler is None:
       await self.close(**_emnsw)
       return
+    if self.decoder is None:
+      await self.close(**_eformat)
+      return
     
     self.user = user
     await self.accept()
     # send message to user to start
-    await self.send({'code': 0, 'detail': 'Connection Accepted.'})
+    await self.send({
+      'code': 0, 'detail': 'Connection Accepted.', 
+      'format': self.format, 'rate': self.rate, 'channels': self.channels,
+    })
     self.addr = (self.socket.client.host, self.socket.client.port)
+    self.backpressure = _handler.backpressure
+    self.backpressure.listeners.add(self.on_backpressure)
+    if self.backpressure.throttled:
+      await self.on_backpressure(True)
     
   async def on_disconnect(self, code: int = -1, reason: Optional[Any] = None) -> None:
     global _handler
+    if self.backpressure is not None:
+      self.backpressure.listeners.discard(self.on_backpressure)
     if _handler:
       _handler.del_provider(self.addr)
       
+  def _decode(self, frames: List[Tuple[int, memoryview]]):
+    # decoded lazily, each chunk is written before the next one reuses the buffers
+    for timestamp_millis, payload in frames:
+      audio_data = self.decoder.decode(payload)
+      if self.resampler is not None:
+        offset, audio_data = self.resampler.process(audio_data)
+        timestamp_millis, audio_data = self._place(timestamp_millis + offset, audio_data)
+        if audio_data.size == 0:
+          continue
+      yield timestamp_millis, audio_data
+
+  def _place(self, time: float, audio_data: NDArray[np.float32]) -> Tuple[int, NDArray[np.float32]]:
+    # resampled chunks do not last whole ms, so they are written one after
+    # the other from a running position, in whole ms with the rest carried
+    # over, and only moved to the client timestamp on a gap or a jump
+    start = time * _ONE_MS_SAMPLE
+    if self.position is None or abs(start - self.position) > _RESYNC_MAX * _ONE_MS_SAMPLE:
+      self.position = round(time) * _ONE_MS_SAMPLE
+      self.carry = self.carry[:0]
+    if self.carry.size > 0:
+      audio_data = np.concatenate((self.carry, audio_data))
+    begin = self.position - self.carry.size
+    self.position = begin + audio_data.size
+    size = audio_data.size - audio_data.size % _ONE_MS_SAMPLE
+    self.carry = audio_data[size:].copy()
+    return begin // _ONE_MS_SAMPLE, audio_data[:size]
+
+  async def _flush(self):
+    # runs once the receive loop waits, so a burst of frames is enqueued at once
+    try:
+      while self.pending:
+        frames, self.pending = self.pending, []
+        handler = _handler
+        if handler is not None:
+          await handler.enqueue_audio_chunks(self._decode(frames))
+    finally:
+      self.flush_task = None
+
+  def _flush_done(self, task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+      default_logger.error(f'Failed to enqueue audio from {self.addr}: {task.exception()!r}')
+
+  async def on_backpressure(self, throttled: bool):
+    # the meeting's policy changed state, after an enqueue or a transcription pass
+    if throttled == self.throttled or self.socket.client_state != WebSocketState.CONNECTED:
+      return
+    self.throttled = throttled
+    if throttled:
+      await self.send({'code': _THROTTLE, 'detail': 'Transcription is behind, pause sending.', 'lag': self.backpressure.lag})
+    else:
+      await self.send({'code': _RESUME, 'detail': 'Resume sending.'})
+
+  async def on_control(self, input_json: Optional[dict]) -> None:
+    if input_json is not None and input_json.get('code') == 1:
+      await self.close()  # under user request
+
   async def on_receive(self, text: Optional[str], bytes: Optional[bytes]) -> None:
     global _handler
-    user_input = bytes or (text.encode('utf-8') if text else b'')
-    await asyncio.sleep(0.01)
+    if text is not None:
+      await self.on_control(_j(text))
+      return
+    if not bytes:
+      return
     
-    # see if it is control data
-    input_json = _j(user_input)
-    if input_json is not None and input_json.get('code') == 1:
-      await self.close()  # under user request
-      
-    # else treat it like formed data
+    view = memoryview(bytes)
+    frame_type = view[0]
+    if frame_type == FRAME_CONTROL:
+      await self.on_control(_j(bytes[1:]))
+      return
+    elif frame_type == FRAME_AUDIO:
+      header = 1
+    elif frame_type == FRAME_LEGACY:
+      header = 0
+    else:  # older clients send json as binary too
+      await self.on_control(_j(bytes))
+      return
+    
+    if len(view) < header + _TIMESTAMP.size:
+      return  # truncated frame
     if not _handler:
       await self.close()
+      return
     if not _handler.provider_active(self.addr):
       return  # discard since the handler is receiving somewhere else
-
-    timestamp_millis = struct.unpack('>Q', user_input[:8])[0]
-    # time_obj = datetime.utcfromtimestamp(timestamp_millis / 1000)
-    audio_data_raw = user_input[8:]
-    audio_data = self.audio_handler(audio_data_raw)
-    # sr=16000, d=16bit
-    await _handler.enqueue_audio_data(timestamp_millis, audio_data)
-  
-
+    
+    timestamp_millis = _TIMESTAMP.unpack_from(view, header)[0]
+    self.pending.append((timestamp_millis, view[header + _TIMESTAMP.size:]))
+    if self.flush_task is None:
+      self.flush_task = asyncio.create_task(self._flush())
+      self.flush_task.add_done_callback(self._flush_done)
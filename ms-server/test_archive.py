@@ -0,0 +1,116 @@
+import pytest
+
+from meeting.archive import ArchiveWriter, ArchiveReader, BLOCK_ROWS, MAGIC
+
+from datetime import datetime, timedelta
+
+T0 = datetime(2024, 1, 1)
+FILLED = {'en': 'translate1'}
+
+
+def record(id: int, ms: int, lang: str = 'en') -> dict:
+  return dict(
+      id=id, time=T0 + timedelta(milliseconds=ms), lang=lang, session='test',
+      text=f'text {id}', translate1=f'text {id}' if lang == 'en' else f'tr {id}',
+      translate2='', translate3=None, translate4='',
+  )
+
+
+def write(path: str, records) -> dict:
+  writer = ArchiveWriter(path, 'test', FILLED)
+  writer.add(records)
+  writer.close()
+  return writer.footer
+
+
+def ids(rows) -> list:
+  return [r['id'] for r in rows]
+
+
+@pytest.fixture
+def path(tmp_path):
+  return str(tmp_path / 'test.archive')
+
+
+def test_round_trip(path):
+  records = [record(i, i * 10, 'en' if i % 3 else 'zh') for i in range(1, BLOCK_ROWS * 2 + 100)]
+  footer = write(path, records)
+  assert len(footer['blocks']) == 3 and footer['through'] == records[-1]['id']
+
+  reader = ArchiveReader(path)
+  rows = list(reader.read())
+  assert ids(rows) == ids(records)
+  # the filled translation is restored from the text
+  assert rows[0]['translate1'] == 'text 1' and rows[2]['translate1'] == 'tr 3'
+  assert rows[0]['translate3'] == '' and rows[0]['session'] == 'test'
+  reader.close()
+
+
+def test_appended_segments_are_merged(path):
+  # a later segment may hold records timed before the end of the first one
+  write(path, [record(i, i * 10) for i in range(1, 11)])
+  footer = write(path, [record(i, (i - 10) * 10 + 5) for i in range(11, 21)])
+  assert footer['segments'] == 2 and footer['through'] == 20
+
+  reader = ArchiveReader(path)
+  rows = list(reader.read())
+  keys = [(r['time'], r['id']) for r in rows]
+  assert keys == sorted(keys) and len(rows) == 20
+  assert ids(rows[:4]) == [1, 11, 2, 12]
+  reader.close()
+
+
+def test_filters_and_cursor(path):
+  records = [record(i, (i // 2) * 10, 'en' if i % 2 else 'zh-TW') for i in range(1, BLOCK_ROWS * 3)]
+  write(path, records[:BLOCK_ROWS])
+  write(path, records[BLOCK_ROWS:])
+  reader = ArchiveReader(path)
+
+  start, end = T0 + timedelta(seconds=1), T0 + timedelta(seconds=2)
+  expected = [r for r in records if start <= r['time'] <= end]
+  assert ids(reader.read(start, end)) == ids(expected)
+  assert ids(reader.read(start, end, 'zh')) == ids(r for r in expected if r['lang'] == 'zh-TW')
+
+  # paging by cursor visits every record once, ties on time included
+  seen, after = [], None
+  while True:
+    page = []
+    for row in reader.read(after=after):
+      page.append(row)
+      if len(page) == 7:
+        break
+    if not page:
+      break
+    seen.extend(ids(page))
+    after = (page[-1]['time'], page[-1]['id'])
+  assert seen == ids(records)
+  reader.close()
+
+
+def test_interrupted_append_is_dropped(path):
+  write(path, [record(i, i * 10) for i in range(1, 11)])
+  with open(path, 'ab') as f:
+    f.write(MAGIC + b'\0' * 100)  # a segment without its trailer
+
+  assert ids(ArchiveReader(path).read()) == list(range(1, 11))
+  footer = write(path, [record(i, i * 10) for i in range(11, 21)])
+  assert footer['segments'] == 2
+  assert ids(ArchiveReader(path).read()) == list(range(1, 21))
+
+
+def test_abort(path):
+  writer = ArchiveWriter(path, 'test', FILLED)
+  writer.add([record(1, 0)])
+  writer.abort()
+  with pytest.raises(FileNotFoundError):
+    ArchiveReader(path)
+
+  write(path, [record(1, 0)])
+  writer = ArchiveWriter(path, 'test', FILLED)
+  writer.add([record(2, 10)] * BLOCK_ROWS)
+  writer.abort()
+  assert ids(ArchiveReader(path).read()) == [1]
+
+
+if __name__ == '__main__':
+  pytest.main([__file__])
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from utils.audio import StreamResampler
+
+
+def tone(rate: int, seconds: float, freq: float = 440) -> np.ndarray:
+  t = np.arange(int(rate * seconds)) / rate
+  return (0.5 * np.sin(2 * np.pi * freq * t)).astype(np.float32)
+
+
+def resample(resampler: StreamResampler, data: np.ndarray, chunk: int):
+  offsets, outputs = [], []
+  for i in range(0, data.size, chunk):
+    offset, y = resampler.process(data[i: i + chunk])
+    offsets.append(offset)
+    outputs.append(y.copy())  # only valid until the next call
+  return offsets, outputs
+
+
+@pytest.mark.parametrize('rate', [8000, 16000, 22050, 44100, 48000])
+@pytest.mark.parametrize('chunk', [1, 37, 960, 10000])
+def test_chunks_carry_filter_history(rate, chunk):
+  data = tone(rate, 0.5)
+  _, whole = resample(StreamResampler(rate), data, data.size)
+  _, chunked = resample(StreamResampler(rate), data, chunk)
+  np.testing.assert_allclose(np.concatenate(chunked), whole[0], atol=1e-5)
+
+
+@pytest.mark.parametrize('rate', [8000, 22050, 48000])
+def test_offsets_follow_the_outputs(rate):
+  chunk = rate // 50  # 20 ms
+  resampler = StreamResampler(rate)
+  offsets, outputs = resample(resampler, tone(rate, 1), chunk)
+  delay_ms = resampler.delay / resampler.up / rate * 1000
+  assert offsets[0] == pytest.approx(-delay_ms)
+
+  # the output of a chunk continues where the previous one stopped
+  time = offsets[0]
+  for i, (offset, y) in enumerate(zip(offsets, outputs)):
+    assert i * 20 + offset == pytest.approx(time)
+    time += y.size / 16
+  # the last `delay_ms` wait for the next chunk
+  assert time == pytest.approx(1000 - delay_ms, abs=1 / 16)
+
+
+@pytest.mark.parametrize('rate', [8000, 44100, 48000])
+def test_tone_is_kept(rate):
+  offsets, outputs = resample(StreamResampler(rate), tone(rate, 1), rate // 50)
+  y = np.concatenate(outputs)
+  # outputs are placed by the offset, which accounts for the filter delay
+  t = offsets[0] / 1000 + np.arange(y.size) / 16000
+  expected = 0.5 * np.sin(2 * np.pi * 440 * t)
+  np.testing.assert_allclose(y[1000: -1000], expected[1000: -1000], atol=1e-2)
+
+
+def test_channels_are_averaged():
+  left, right = tone(16000, 0.1), tone(16000, 0.1, 1000)
+  stereo = np.stack([left, right], axis=1).reshape(-1)
+  offset, y = StreamResampler(16000, channels=2).process(stereo)
+  assert offset == 0
+  np.testing.assert_allclose(y, (left + right) / 2, atol=1e-6)
+
+
+if __name__ == '__main__':
+  pytest.main([__file__])
@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from meeting.search import SearchIndex, index_terms, match_query, snippet
+
+from datetime import datetime
+
+
+def test_index_terms():
+  assert index_terms('hello world').split() == ['hello', 'world']
+  assert index_terms('會議記錄').split() == ['會議', '議記', '記錄', '錄']
+  assert index_terms('字').split() == ['字']
+  assert index_terms('Zoom會議ok').split() == ['Zoom', '會議', '議', 'ok']
+
+
+def test_match_query():
+  assert match_query('hello "world') == ('"hello"* "world"*', ['hello', 'world'])
+  assert match_query('會議記錄') == ('"會議 議記 記錄"', ['會議記錄'])
+  assert match_query('錄') == ('"錄"*', ['錄'])
+  assert match_query('Zoom會議') == ('"Zoom"* "會議"', ['Zoom', '會議'])
+  assert match_query(' * ') == ('', [])
+
+
+def test_snippet():
+  text = 'x' * 100 + 'Hello there, hello' + 'y' * 100
+  part, spans = snippet(text, ['hello'])
+  assert part == text[60:145]  # around the first match only
+  assert [part[s:e] for s, e in spans] == ['Hello', 'hello']
+  assert snippet('abc', ['z']) == ('abc', [])
+
+
+@pytest.mark.parametrize('query, found', [
+    ('會議', True),
+    ('記錄', True),
+    ('會', True),
+    ('錄', True),  # the last character of the run
+    ('議記', True),
+    ('錄會', False),
+    ('meeting', True),
+    ('meet', True),
+    ('eting', False),
+])
+def test_search(tmp_path, query, found):
+
+  async def run():
+    index = SearchIndex(str(tmp_path / 'search.sqlite'))
+    await index.add([dict(
+        session='test', record=1, time=datetime(2024, 1, 1), lang='zh-TW',
+        text='Meeting 會議記錄', source=1,
+    )])
+    try:
+      return await index.search(query)
+    finally:
+      await index.close()
+
+  results = asyncio.run(run())
+  assert bool(results) == found
+  if found:
+    assert results[0]['id'] == 1 and results[0]['snippet'] == 'Meeting 會議記錄'
+
+
+if __name__ == '__main__':
+  pytest.main([__file__])
@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+
+from transcribe.timeline import AudioTimeline
+
+MS = 16  # samples per ms
+
+
+def ramp(start: int, size: int) -> np.ndarray:
+  return np.arange(start, start + size, dtype=np.float32)
+
+
+def test_window_of_written_audio():
+  timeline = AudioTimeline(100 * MS)
+  assert timeline.write(1000, ramp(0, 30 * MS)) is not None
+  start_time, data, cut = timeline.window(1000 * MS)
+  assert start_time == 1000 and not cut
+  np.testing.assert_array_equal(data, ramp(0, 30 * MS))
+
+
+def test_window_across_wrap_around():
+  timeline = AudioTimeline(100 * MS)
+  for i in range(7):
+    timeline.write(i * 30, ramp(i * 30 * MS, 30 * MS))
+    timeline.release(timeline.end - 60 * MS)  # keep the last 60 ms
+
+  # 210 ms were written through a 100 ms ring, the window is still contiguous
+  start_time, data, _ = timeline.window(1000 * MS)
+  assert start_time == 150
+  np.testing.assert_array_equal(data, ramp(150 * MS, 60 * MS))
+
+
+def test_overflow_drops_the_oldest_samples():
+  timeline = AudioTimeline(100 * MS)
+  timeline.write(0, ramp(0, 80 * MS))
+  timeline.write(80, ramp(80 * MS, 50 * MS))
+  assert timeline.size == 100 * MS
+  assert timeline.dropped == 30 * MS
+  start_time, data, _ = timeline.window(1000 * MS)
+  assert start_time == 30
+  np.testing.assert_array_equal(data, ramp(30 * MS, 100 * MS))
+
+
+def test_short_gap_is_silent_and_overlaps_are_mixed():
+  timeline = AudioTimeline(100 * MS)
+  timeline.write(0, np.ones(10 * MS, dtype=np.float32))
+  timeline.write(20, np.ones(10 * MS, dtype=np.float32))
+  timeline.write(25, np.ones(10 * MS, dtype=np.float32))
+  _, data, _ = timeline.window(1000 * MS)
+  assert data.size == 35 * MS
+  assert not data[10 * MS: 20 * MS].any()
+  np.testing.assert_array_equal(data[25 * MS: 30 * MS], 2)
+
+
+def test_released_slots_are_zeroed():
+  timeline = AudioTimeline(100 * MS)
+  timeline.write(0, np.ones(100 * MS, dtype=np.float32))
+  timeline.release(timeline.end)
+  # mixed into zeroed slots, not into the released audio
+  timeline.write(100, np.ones(100 * MS, dtype=np.float32))
+  _, data, _ = timeline.window(1000 * MS)
+  np.testing.assert_array_equal(data, 1)
+
+
+def test_long_gap_becomes_a_break():
+  timeline = AudioTimeline(100 * MS, gap_max=20)
+  timeline.write(0, ramp(0, 10 * MS))
+  timeline.write(5000, ramp(1000, 10 * MS))
+  assert timeline.size == 20 * MS  # the gap takes no room
+
+  start_time, data, cut = timeline.window(1000 * MS)
+  assert start_time == 0 and cut
+  np.testing.assert_array_equal(data, ramp(0, 10 * MS))
+
+  timeline.release(timeline.start + data.size)
+  start_time, data, cut = timeline.window(1000 * MS)
+  assert start_time == 5000 and not cut
+  np.testing.assert_array_equal(data, ramp(1000, 10 * MS))
+
+
+def test_consumed_head_is_not_written_again():
+  timeline = AudioTimeline(100 * MS)
+  timeline.write(0, ramp(0, 20 * MS))
+  timeline.release(timeline.start + 10 * MS)
+  assert timeline.write(0, ramp(0, 5 * MS)) is None
+  timeline.write(5, np.ones(10 * MS, dtype=np.float32))
+  start_time, data, _ = timeline.window(1000 * MS)
+  assert start_time == 10
+  np.testing.assert_array_equal(data[:5 * MS], ramp(10 * MS, 5 * MS) + 1)
+
+
+@pytest.mark.parametrize('time', [0, 500, 5000])
+def test_clear_anchors_the_next_write(time):
+  timeline = AudioTimeline(100 * MS)
+  timeline.write(1000, ramp(0, 30 * MS))
+  timeline.clear()
+  assert timeline.empty
+  assert timeline.write(time, ramp(0, 10 * MS)) is not None
+  start_time, data, _ = timeline.window(1000 * MS)
+  assert start_time == time
+  np.testing.assert_array_equal(data, ramp(0, 10 * MS))
+
+
+if __name__ == '__main__':
+  pytest.main([__file__])
@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+import meeting.writer
+from meeting.writer import TranscriptWriter
+
+from datetime import datetime
+
+
+class FakeClock:
+
+  def __init__(self):
+    self.now = 0.0
+
+  def monotonic(self) -> float:
+    return self.now
+
+
+@pytest.fixture
+def written(monkeypatch):
+  rows = []
+  flushed = asyncio.Event()
+
+  async def add_records(database, batch):
+    rows.extend(batch)
+    flushed.set()
+
+  monkeypatch.setattr(meeting.writer, 'add_records', add_records)
+  return rows, flushed
+
+
+def test_single_row(written, monkeypatch):
+  rows, flushed = written
+  clock = FakeClock()
+  monkeypatch.setattr(meeting.writer, 'time', clock)
+
+  async def run():
+    writer = TranscriptWriter(None, 'test', max_batch=64, max_delay=0.01)
+    writer.start()
+    await writer.add(datetime.utcnow(), 'one row', 'en')
+
+    # the writer wakes up, but the deadline has not passed on its clock
+    for _ in range(5):
+      await asyncio.sleep(0.02)
+    assert rows == [] and writer.flushes == 0, writer.get_stats()
+
+    clock.now += 1
+    await asyncio.wait_for(flushed.wait(), 5)
+    # written by the interval, not by close
+    assert len(rows) == 1 and writer.flushes == 1, writer.get_stats()
+    await writer.close()
+    assert writer.flushes == 1
+
+  asyncio.run(run())
+
+
+def test_drain(written):
+  rows, _ = written
+
+  async def run():
+    writer = TranscriptWriter(None, 'test', max_batch=2, max_delay=60)
+    for i in range(5):
+      await writer.add(datetime.utcnow(), f'row {i}', 'en')
+
+    assert await writer.drain()
+    assert len(rows) == 5 and not writer.journal, writer.get_stats()
+    assert writer.flushes == 3
+    await writer.close()
+
+  asyncio.run(run())
+
+
+if __name__ == '__main__':
+  pytest.main([__file__])
@@ -0,0 +1,207 @@
+from typing import Optional, List, Dict, Any, Tuple
+
+import time
+import queue
+import logging
+import threading
+import concurrent.futures
+from dataclasses import dataclass, field
+
+import whisper
+import numpy as np
+from numpy.typing import NDArray
+
+from transcribe.decoding import ReducedContextModel
+from transcribe.executor import Priority, inference_executor
+from transcribe.language import detect_language
+
+default_logger = logging.getLogger(__name__)
+
+
+def options_key(options: Dict[str, Any]) -> Tuple[Tuple[str, str], ...]:
+  # windows decoded with equal options can share a batch
+  return tuple(sorted((k, repr(v)) for k, v in options.items()))
+
+
+@dataclass
+class _Request:
+  command: str  # transcribe or detect
+  audio: NDArray[np.float32]
+  argument: Any  # options or language candidates
+  mel: Optional[NDArray[np.float32]] = None
+  priority: Priority = Priority.PARTIAL
+  future: concurrent.futures.Future = field(default_factory=concurrent.futures.Future)
+
+
+class BatchInferenceService:
+  '''Batches the passes of the workers sharing a Whisper model.
+
+  Windows submitted by the workers of concurrent meetings are collected for
+  at most `max_delay` after the first one arrives, grouped by decoding
+  options, and transcribed as batches of up to `max_batch` windows: one
+  encoder pass over the stacked log-mel spectrograms and one batched
+  decoding. Batches run on `inference_executor` at the most urgent
+  priority of their windows. With a single worker there is nothing to
+  wait for, so windows are sent right away. Used as a model proxy,
+  `transcribe` blocks the calling thread until the batch holding the
+  window is done.
+  '''
+
+  accepts_mel = True
+  accepts_priority = True
+  schedules_inference = True
+
+  def __init__(
+      self,
+      model: whisper.Whisper,
+      max_batch: int = 8,
+      max_delay: float = 0.05,  # in seconds
+      bucket: int = 0,  # see ReducedContextModel, 0 for the full context
+      logger: Optional[logging.Logger] = None,
+  ):
+    self.model = model
+    self.runner = ReducedContextModel(model, bucket, logger)
+    self.max_batch = max_batch
+    self.max_delay = max_delay
+    self.users = 0  # workers sharing the service
+    self.logger = logger or default_logger
+
+    self.queue: 'queue.Queue[Optional[_Request]]' = queue.Queue()
+    self.thread: Optional[threading.Thread] = None
+    self.batches = 0
+    self.items = 0
+
+  # lifecycle
+
+  def start(self):
+    if self.thread is None:
+      self.thread = threading.Thread(target=self._serve, daemon=True)
+      self.thread.start()
+
+  def stop(self):
+    thread, self.thread = self.thread, None
+    if thread is not None:
+      self.queue.put(None)
+      thread.join()
+
+  @property
+  def mean_batch_size(self) -> float:
+    return self.items / self.batches if self.batches else 0.0
+
+  # model proxy
+
+  def _submit(self, request: _Request):
+    if self.thread is None:
+      raise RuntimeError('Batch inference service is not running.')
+    self.queue.put(request)
+    return request.future.result()
+
+  def transcribe(
+      self,
+      audio: NDArray[np.float32],
+      mel: Optional[NDArray[np.float32]] = None,
+      priority: Priority = Priority.PARTIAL,
+      **options
+  ) -> Dict[str, Any]:
+    return self._submit(_Request('transcribe', audio, options, mel, priority))
+
+  def detect_audio_language(self, audio: NDArray[np.float32], candidates: Optional[List[str]] = None) -> Tuple[str, float]:
+    return self._submit(_Request('detect', audio, candidates))
+
+  # collecting thread
+
+  def _collect(self, first: _Request) -> Tuple[List[_Request], bool]:
+    requests = [first]
+    deadline = time.monotonic() + (self.max_delay if self.users > 1 else 0)
+    while len(requests) < self.max_batch:
+      timeout = deadline - time.monotonic()
+      if timeout <= 0:
+        break
+      try:
+        request = self.queue.get(timeout=timeout)
+      except queue.Empty:
+        break
+      if request is None:
+        return requests, True
+      requests.append(request)
+    return requests, False
+
+  def _serve(self):
+    stopping = False
+    while not stopping:
+      first = self.queue.get()
+      if first is None:
+        break
+      requests, stopping = self._collect(first)
+
+      groups: Dict[Any, List[_Request]] = {}
+      for r in requests:
+        key = options_key(r.argument) if r.command == 'transcribe' else None
+        groups.setdefault(key, []).append(r)
+      for key, group in groups.items():
+        if key is None:
+          for r in group:
+            inference_executor.submit(self._detect, r, priority=r.priority)
+        else:
+          inference_executor.submit(
+              self._run_batch, group, priority=min(r.priority for r in group))
+
+    # fail whatever is left
+    while True:
+      try:
+        request = self.queue.get_nowait()
+      except queue.Empty:
+        break
+      if request is not None:
+        request.future.set_exception(RuntimeError('Batch inference service stopped.'))
+
+  # on inference_executor
+
+  def _detect(self, request: _Request):
+    try:
+      request.future.set_result(detect_language(self.runner.model, request.audio, request.argument))
+    except Exception as e:
+      request.future.set_exception(e)
+
+  def _run_batch(self, group: List[_Request]):
+    options = group[0].argument
+    try:
+      results = self.runner.transcribe_batch(
+          [r.audio for r in group], [r.mel for r in group], **options)
+    except Exception as e:
+      self.logger.error(f'Batched transcription of {len(group)} windows failed: {e!r}')
+      for r in group:
+        r.future.set_exception(e)
+      return
+    self.batches += 1
+    self.items += len(group)
+    for r, result in zip(group, results):
+      r.future.set_result(result)
+
+
+# one service per loaded model
+_services: Dict[int, Tuple[BatchInferenceService, int]] = {}
+
+
+def acquire_service(model: whisper.Whisper, **kwargs) -> BatchInferenceService:
+  '''Get the running service of `model`, starting it with `kwargs` if
+  there is none. Release it with release_service.
+  '''
+  service, refs = _services.get(id(model), (None, 0))
+  if service is None:
+    service = BatchInferenceService(model, **kwargs)
+    service.start()
+  _services[id(model)] = service, refs + 1
+  service.users = refs + 1
+  return service
+
+
+def release_service(service: BatchInferenceService):
+  key = id(service.model)
+  _, refs = _services.get(key, (service, 1))
+  if refs > 1:
+    _services[key] = service, refs - 1
+    service.users = refs - 1
+    return
+  _services.pop(key, None)
+  service.stop()
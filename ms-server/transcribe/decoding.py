@@ -0,0 +1,264 @@
+from typing import Optional, List, Dict, Any, Tuple, Union
+
+import math
+import logging
+import whisper
+import torch
+import torch.nn.functional as F
+import numpy as np
+from numpy.typing import NDArray
+
+from whisper.audio import HOP_LENGTH, N_SAMPLES, SAMPLE_RATE, CHUNK_LENGTH, log_mel_spectrogram
+from whisper.decoding import DecodingOptions, DecodingResult, DecodingTask
+from whisper.tokenizer import Tokenizer, get_tokenizer
+
+from transcribe.language import detect_language
+from transcribe.mel import normalize_mel
+
+default_logger = logging.getLogger(__name__)
+
+# options of model.transcribe that are not decoding options
+_TRANSCRIBE_OPTIONS = {
+    'verbose', 'temperature', 'compression_ratio_threshold', 'logprob_threshold',
+    'no_speech_threshold', 'condition_on_previous_text', 'initial_prompt',
+    'word_timestamps', 'prepend_punctuations', 'append_punctuations',
+    'clip_timestamps', 'hallucination_silence_threshold',
+}
+
+
+def encode(model: whisper.Whisper, mel: torch.Tensor, n_audio_ctx: int) -> torch.Tensor:
+  '''AudioEncoder.forward over `n_audio_ctx` positions instead of all.
+  '''
+  encoder = model.encoder
+  x = F.gelu(encoder.conv1(mel))
+  x = F.gelu(encoder.conv2(x))
+  x = x.permute(0, 2, 1)
+  x = (x + encoder.positional_embedding[:n_audio_ctx]).to(x.dtype)
+  for block in encoder.blocks:
+    x = block(x)
+  return encoder.ln_post(x)
+
+
+class _FeatureDecodingTask(DecodingTask):
+  # takes encoded audio features of any context length
+
+  def _get_audio_features(self, mel: torch.Tensor):
+    return mel
+
+
+def detect_feature_language(model: whisper.Whisper, features: torch.Tensor, tokenizer: Tokenizer) -> List[str]:
+  tokens = torch.tensor([[tokenizer.sot]] * features.shape[0], device=model.device)
+  logits = model.logits(tokens, features)[:, 0]
+  mask = torch.ones(logits.shape[-1], dtype=torch.bool)
+  mask[list(tokenizer.all_language_tokens)] = False
+  logits[:, mask] = -np.inf
+  language_tokens = tokenizer.all_language_tokens
+  return [tokenizer.all_language_codes[language_tokens.index(token)]
+          for token in logits.argmax(dim=-1).tolist()]
+
+
+def split_segments(
+    result: DecodingResult,
+    tokenizer: Tokenizer,
+    duration: float,
+    time_precision: float,
+) -> List[Dict[str, Any]]:
+  '''Cut decoded tokens into segments at consecutive timestamp tokens, the
+  same way model.transcribe does for a single window.
+  '''
+  tokens = result.tokens
+  timestamp_begin = tokenizer.timestamp_begin
+  is_timestamp = [t >= timestamp_begin for t in tokens]
+  consecutive = [i + 1 for i in range(len(tokens) - 1)
+                 if is_timestamp[i] and is_timestamp[i + 1]]
+
+  def _segment(sliced: List[int], start: float, end: float):
+    return dict(
+        seek=0,
+        start=start,
+        end=end,
+        text=tokenizer.decode([t for t in sliced if t < tokenizer.eot]),
+        tokens=sliced,
+        temperature=result.temperature,
+        avg_logprob=result.avg_logprob,
+        compression_ratio=result.compression_ratio,
+        no_speech_prob=result.no_speech_prob,
+    )
+
+  segments = []
+  last_slice = 0
+  for current_slice in consecutive:
+    sliced = tokens[last_slice:current_slice]
+    segments.append(_segment(
+        sliced,
+        (sliced[0] - timestamp_begin) * time_precision,
+        (sliced[-1] - timestamp_begin) * time_precision,
+    ))
+    last_slice = current_slice
+
+  rest = tokens[last_slice:]
+  if any(t < tokenizer.eot for t in rest):
+    # text without a closing timestamp pair runs to the last timestamp or the end
+    start = (rest[0] - timestamp_begin) * time_precision if is_timestamp[last_slice] else 0.0
+    end = duration
+    if len(rest) > 1 and rest[-1] >= timestamp_begin and rest[-1] != rest[0]:
+      end = (rest[-1] - timestamp_begin) * time_precision
+    segments.append(_segment(rest, start, max(end, start)))
+
+  for i, s in enumerate(segments):
+    s['id'] = i
+  return segments
+
+
+class ReducedContextModel:
+  '''Whisper model wrapper that runs the encoder over an audio context
+  trimmed to the window length, rounded up to `bucket` positions, and
+  decodes against the trimmed features. A bucket of 0 keeps the full
+  context. Several windows can be decoded as one batch, and unnormalized
+  log-mel frames computed beforehand (see MelCache) can be passed along
+  with the audio.
+
+  Output that degrades (repetitive or improbable text, or timestamps past
+  the end of the audio) is thrown away and the window is transcribed again
+  by the model with the full 30s context. So are windows that need word
+  timestamps or are longer than 30s.
+  '''
+
+  accepts_mel = True
+
+  def __init__(
+      self,
+      model: whisper.Whisper,
+      bucket: int = 100,  # in encoder positions, 20ms each
+      logger: Optional[logging.Logger] = None,
+  ):
+    self.model = model
+    self.bucket = bucket
+    self.logger = logger or default_logger
+    self.fallbacks = 0
+
+  def detect_audio_language(self, audio: NDArray[np.float32], candidates: Optional[List[str]] = None) -> Tuple[str, float]:
+    return detect_language(self.model, audio, candidates)
+
+  def transcribe(self, audio: NDArray[np.float32], mel: Optional[NDArray[np.float32]] = None, **options) -> Dict[str, Any]:
+    return self.transcribe_batch([audio], [mel], **options)[0]
+
+  def transcribe_batch(
+      self,
+      audios: List[NDArray[np.float32]],
+      mels: Optional[List[Optional[NDArray[np.float32]]]] = None,
+      **options
+  ) -> List[Dict[str, Any]]:
+    if options.get('word_timestamps') or any(a.size == 0 or a.size > N_SAMPLES for a in audios):
+      return [self.model.transcribe(a, **options) for a in audios]
+    with torch.no_grad():
+      results = self._transcribe_reduced(audios, mels or [None] * len(audios), **options)
+    for i, result in enumerate(results):
+      if result is None:
+        self.fallbacks += 1
+        results[i] = self.model.transcribe(audios[i], **options)
+    return results
+
+  def _transcribe_reduced(
+      self,
+      audios: List[NDArray[np.float32]],
+      mels: List[Optional[NDArray[np.float32]]],
+      temperature: Union[float, Tuple[float, ...]] = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0),
+      compression_ratio_threshold: Optional[float] = 2.4,
+      logprob_threshold: Optional[float] = -1.0,
+      no_speech_threshold: Optional[float] = 0.6,
+      initial_prompt: Optional[str] = None,
+      fp16: bool = True,
+      **options
+  ) -> List[Optional[Dict[str, Any]]]:
+    model = self.model
+    dims = model.dims
+    if model.device == torch.device('cpu'):
+      fp16 = False
+    decode_options = {k: v for k, v in options.items() if k not in _TRANSCRIBE_OPTIONS}
+    decode_options.pop('fp16', None)
+    task = decode_options.pop('task', 'transcribe')
+    language = decode_options.pop('language', None)
+
+    # trimmed mel & features of the whole batch
+    n_audio_ctx = dims.n_audio_ctx
+    if self.bucket > 0:
+      n_audio_ctx = min(max(
+          math.ceil(a.size / (HOP_LENGTH * 2) / self.bucket) * self.bucket
+          for a in audios), n_audio_ctx)
+    n_frames = n_audio_ctx * 2
+    mel = torch.stack([
+        torch.from_numpy(normalize_mel(m, n_frames))
+        if m is not None and m.shape[0] == dims.n_mels else
+        log_mel_spectrogram(a, dims.n_mels, padding=n_frames * HOP_LENGTH - a.size)[:, :n_frames]
+        for a, m in zip(audios, mels)
+    ]).to(model.device).to(torch.float16 if fp16 else torch.float32)
+    features = encode(model, mel, n_audio_ctx)
+
+    if language is not None:
+      languages = [language] * len(audios)
+    elif not model.is_multilingual:
+      languages = ['en'] * len(audios)
+    else:
+      languages = detect_feature_language(
+          model, features, get_tokenizer(True, num_languages=model.num_languages))
+
+    results: List[Optional[Dict[str, Any]]] = [None] * len(audios)
+    time_precision = CHUNK_LENGTH / dims.n_audio_ctx
+    for lang in set(languages):
+      indices = [i for i, l in enumerate(languages) if l == lang]
+      tokenizer = get_tokenizer(
+          model.is_multilingual,
+          num_languages=model.num_languages,
+          language=lang,
+          task=task,
+      )
+      prompt = tokenizer.encode(' ' + initial_prompt.strip()) if initial_prompt else None
+
+      # decode with temperature fallback, only re-decoding degraded items
+      temperatures = [temperature] if isinstance(temperature, (int, float)) else temperature
+      decoded: Dict[int, Tuple[DecodingResult, bool]] = {}
+      pending = indices
+      for t in temperatures:
+        if not pending:
+          break
+        kwargs = {**decode_options}
+        if t > 0:
+          kwargs.pop('beam_size', None)
+          kwargs.pop('patience', None)
+        else:
+          kwargs.pop('best_of', None)
+        outputs = _FeatureDecodingTask(model, DecodingOptions(
+            language=lang, task=task, temperature=t, prompt=prompt, fp16=fp16, **kwargs
+        )).run(features[pending])
+
+        still_pending = []
+        for i, result in zip(pending, outputs):
+          needs_fallback = \
+              (compression_ratio_threshold is not None and result.compression_ratio > compression_ratio_threshold) or \
+              (logprob_threshold is not None and result.avg_logprob < logprob_threshold)
+          if no_speech_threshold is not None and result.no_speech_prob > no_speech_threshold:
+            needs_fallback = False
+          decoded[i] = result, needs_fallback
+          if needs_fallback:
+            still_pending.append(i)
+        pending = still_pending
+
+      for i, (result, needs_fallback) in decoded.items():
+        if needs_fallback:
+          continue  # degraded, use the full context
+        duration = audios[i].size / SAMPLE_RATE
+        segments = []
+        no_speech = no_speech_threshold is not None and result.no_speech_prob > no_speech_threshold and \
+            (logprob_threshold is None or result.avg_logprob < logprob_threshold)
+        if not no_speech:
+          segments = split_segments(result, tokenizer, duration, time_precision)
+          if any(s['end'] > duration + 0.5 for s in segments):
+            continue  # timestamps past the audio
+        results[i] = dict(
+            text=''.join(s['text'] for s in segments),
+            segments=segments,
+            language=lang,
+        )
+
+    return results
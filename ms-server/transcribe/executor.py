@@ -0,0 +1,147 @@
+from typing import Optional, Dict, Any, Callable
+from dataclasses import dataclass
+from enum import IntEnum
+
+import time
+import queue
+import asyncio
+import logging
+import itertools
+import threading
+import concurrent.futures
+
+import torch
+
+from config import AppConfig
+
+default_logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+  PARTIAL = 0  # live passes whose output is shown right away
+  FINAL = 1  # re-decoding of spans about to be committed
+  BACKGROUND = 2  # work nobody is waiting on
+
+
+@dataclass
+class _Stats:
+  submitted: int = 0
+  completed: int = 0
+  queued: int = 0
+  wait_total: float = 0  # in seconds
+  wait_max: float = 0  # in seconds
+
+
+class InferenceExecutor:
+  '''Fixed pool of threads running model inference.
+
+  Jobs are picked by priority, then in submission order, so live passes
+  overtake queued final and background work. Each worker sets its torch
+  intra-op thread count when it starts, so inference uses at most
+  `workers * num_threads` cores whatever the number of meetings.
+  '''
+
+  def __init__(
+      self,
+      workers: int = 1,
+      num_threads: int = 0,  # intra-op threads per worker, 0 for torch's default
+      interop_threads: int = 0,  # process-wide, 0 for torch's default
+      logger: Optional[logging.Logger] = None,
+  ):
+    self.workers = max(workers, 1)
+    self.num_threads = num_threads
+    self.interop_threads = interop_threads
+    self.logger = logger or default_logger
+
+    self.queue: queue.PriorityQueue = queue.PriorityQueue()
+    self.counter = itertools.count()
+    self.threads = []
+    self.lock = threading.Lock()
+    self.stats: Dict[Priority, _Stats] = {p: _Stats() for p in Priority}
+
+  def configure_thread(self):
+    '''Apply the intra-op thread count to the calling thread.
+    '''
+    if self.num_threads > 0:
+      torch.set_num_threads(self.num_threads)
+
+  def _start(self):
+    if self.interop_threads > 0:
+      try:
+        torch.set_num_interop_threads(self.interop_threads)
+      except RuntimeError as e:  # inter-op work already started
+        self.logger.warning(f'Cannot set inter-op threads: {e}')
+    for i in range(self.workers):
+      thread = threading.Thread(target=self._work, name=f'inference-{i}', daemon=True)
+      thread.start()
+      self.threads.append(thread)
+
+  def _work(self):
+    self.configure_thread()
+    while True:
+      priority, _, job = self.queue.get()
+      if job is None:
+        break
+      future, f, args, submitted = job
+      wait = time.monotonic() - submitted
+      with self.lock:
+        stats = self.stats[priority]
+        stats.queued -= 1
+        stats.wait_total += wait
+        stats.wait_max = max(stats.wait_max, wait)
+      if not future.set_running_or_notify_cancel():
+        continue
+      try:
+        result = f(*args)
+      except BaseException as e:
+        future.set_exception(e)
+      else:
+        future.set_result(result)
+      with self.lock:
+        stats.completed += 1
+
+  def submit(self, f: Callable, *args, priority: Priority = Priority.PARTIAL) -> concurrent.futures.Future:
+    future = concurrent.futures.Future()
+    with self.lock:
+      if not self.threads:
+        self._start()
+      stats = self.stats[priority]
+      stats.submitted += 1
+      stats.queued += 1
+    self.queue.put((priority, next(self.counter), (future, f, args, time.monotonic())))
+    return future
+
+  def run(self, f: Callable, *args, priority: Priority = Priority.PARTIAL) -> asyncio.Future:
+    '''Awaitable version of submit. Cancelling it drops the job if it has
+    not started yet.
+    '''
+    return asyncio.wrap_future(self.submit(f, *args, priority=priority))
+
+  def shutdown(self):
+    with self.lock:
+      threads, self.threads = self.threads, []
+    for _ in threads:
+      # after every queued job
+      self.queue.put((len(Priority), next(self.counter), None))
+    for thread in threads:
+      thread.join()
+
+  def get_stats(self) -> Dict[str, Any]:
+    with self.lock:
+      return {
+          p.name.lower(): dict(
+              submitted=s.submitted,
+              completed=s.completed,
+              queued=s.queued,
+              wait_mean=s.wait_total / (s.submitted - s.queued) if s.submitted > s.queued else 0.0,
+              wait_max=s.wait_max,
+          )
+          for p, s in self.stats.items()
+      }
+
+
+inference_executor = InferenceExecutor(
+    AppConfig.InferenceWorkers,
+    AppConfig.InferenceThreads,
+    AppConfig.InferenceInteropThreads,
+)
@@ -0,0 +1,92 @@
+from typing import Optional, List, Dict, Any, Tuple
+
+import whisper
+import numpy as np
+from numpy.typing import NDArray
+
+# config codes that differ from whisper's
+_LANGUAGE_ALIASES = {
+    'jp': 'ja',
+}
+
+
+def normalize_language(lang: str):
+  return _LANGUAGE_ALIASES.get(lang, lang)
+
+
+def detect_language(
+    model: whisper.Whisper,
+    audio: NDArray[np.float32],
+    candidates: Optional[List[str]] = None,
+) -> Tuple[str, float]:
+  '''Detect the language of the first 30s of `audio`, restricted to
+  `candidates` if given. Returns the language and its probability among
+  the considered languages.
+  '''
+  detect = getattr(model, 'detect_audio_language', None)
+  if detect is not None:  # model proxies
+    return detect(audio, candidates)
+
+  mel = whisper.log_mel_spectrogram(
+      whisper.pad_or_trim(audio), model.dims.n_mels).to(model.device)
+  _, probs = model.detect_language(mel)
+  if candidates:
+    probs = {c: probs.get(c, 0.0) for c in candidates}
+  lang = max(probs, key=probs.get)
+  total = sum(probs.values())
+  return lang, (probs[lang] / total if total > 0 else 0.0)
+
+
+class LanguageTracker:
+  '''Pins the detected language for subsequent passes.
+
+  The language is detected once and passed to the model until the output
+  gets unreliable, the re-detection interval runs out, or, with
+  `per_utterance`, the current utterance ends.
+  '''
+
+  def __init__(
+      self,
+      candidates: Optional[List[str]] = None,
+      interval: int = 60000,  # ms of audio, 0 for no limit
+      per_utterance: bool = True,
+      min_probability: float = 0.5,
+      min_logprob: float = -1.0,
+      no_speech_threshold: float = 0.6,
+  ):
+    self.candidates = [normalize_language(c) for c in candidates] if candidates else None
+    self.interval = interval
+    self.per_utterance = per_utterance
+    self.min_probability = min_probability
+    self.min_logprob = min_logprob
+    self.no_speech_threshold = no_speech_threshold
+
+    self.language: Optional[str] = None
+    self.confident = False
+    self.pinned_at = 0
+
+  def pin(self, language: str, probability: float, time: int):
+    self.language = language
+    self.confident = probability >= self.min_probability
+    self.pinned_at = time
+
+  def observe(self, result: Dict[str, Any], time: int):
+    '''Check the output of a pass made with the pinned language.
+    '''
+    if self.language is None:
+      return
+    segments = [s for s in result.get('segments', [])
+                if s.get('no_speech_prob', 0) < self.no_speech_threshold]
+    unreliable = bool(segments) and \
+        np.mean([s['avg_logprob'] for s in segments]) < self.min_logprob
+    expired = self.interval > 0 and time - self.pinned_at >= self.interval
+    if unreliable or expired or not self.confident:
+      self.reset()
+
+  def end_utterance(self):
+    if self.per_utterance:
+      self.reset()
+
+  def reset(self):
+    self.language = None
+    self.confident = False
@@ -0,0 +1,150 @@
+from typing import Optional
+
+import torch
+import numpy as np
+from numpy.typing import NDArray
+
+from whisper.audio import N_FFT, HOP_LENGTH, mel_filters
+
+from transcribe.timeline import AudioTimeline
+
+HALF_FFT = N_FFT // 2
+SILENT_FRAME = -10.0  # raw log-mel of zero samples
+
+
+def log_mel_frames(samples: NDArray[np.float32], n_mels: int = 80) -> NDArray[np.float32]:
+  '''Unnormalized log10 mel spectrogram of `samples` without centering:
+  frame i covers samples [i * HOP_LENGTH, i * HOP_LENGTH + N_FFT).
+  '''
+  if samples.size < N_FFT:
+    return np.zeros((n_mels, 0), dtype=np.float32)
+  audio = torch.from_numpy(samples)
+  window = torch.hann_window(N_FFT)
+  stft = torch.stft(audio, N_FFT, HOP_LENGTH, window=window, center=False, return_complex=True)
+  mel_spec = mel_filters(audio.device, n_mels) @ (stft.abs() ** 2)
+  return torch.clamp(mel_spec, min=1e-10).log10().numpy()
+
+
+def normalize_mel(frames: NDArray[np.float32], n_frames: int) -> NDArray[np.float32]:
+  '''Pad unnormalized frames with silence to `n_frames` and normalize them
+  the way whisper.log_mel_spectrogram does.
+  '''
+  mel = np.full((frames.shape[0], n_frames), SILENT_FRAME, dtype=np.float32)
+  n = min(frames.shape[1], n_frames)
+  mel[:, :n] = frames[:, :n]
+  mel = np.maximum(mel, mel.max() - 8.0)
+  return (mel + 4.0) / 4.0
+
+
+def _padded(data: NDArray[np.float32], lo: int, hi: int) -> NDArray[np.float32]:
+  # data[lo:hi] with zeros outside of data
+  out = np.zeros((hi - lo,), dtype=np.float32)
+  a, b = max(lo, 0), min(hi, data.size)
+  if b > a:
+    out[a - lo: b - lo] = data[a: b]
+  return out
+
+
+class MelCache:
+  '''Rolling cache of log-mel frames aligned to an AudioTimeline.
+
+  Frame k is centered at virtual position `phase + k * HOP_LENGTH` and is
+  only cached once all the samples it covers are written, so each pass
+  computes frames for new audio only. Frames of released audio are
+  dropped, and a chunk mixed into written audio invalidates the frames it
+  touches. Windows must start on the frame grid; `align` rounds release
+  positions onto it.
+  '''
+
+  def __init__(
+      self,
+      capacity: int,  # in frames
+      n_mels: int = 80,
+  ):
+    self.capacity = capacity
+    self.n_mels = n_mels
+    self.frames = np.zeros((n_mels, capacity * 2), dtype=np.float32)
+    self.phase = 0
+    self.first = 0  # grid index of the first cached frame
+    self.head = 0  # column of the first cached frame
+    self.count = 0
+
+  def _index(self, pos: int) -> int:
+    return (pos - self.phase) // HOP_LENGTH
+
+  def _center(self, k: int) -> int:
+    return self.phase + k * HOP_LENGTH
+
+  def align(self, pos: int) -> int:
+    '''The closest frame boundary at or before `pos`.
+    '''
+    return pos - (pos - self.phase) % HOP_LENGTH
+
+  def clear(self):
+    self.head = self.count = 0
+
+  def invalidate(self, pos: int):
+    '''Drop the cached frames covering samples from `pos` on.
+    '''
+    k = (pos - HALF_FFT - self.phase) // HOP_LENGTH + 1
+    self.count = max(min(self.count, k - self.first), 0)
+
+  def _drop(self, k: int):
+    if self.count == 0 or not self.first <= k <= self.first + self.count:
+      self.first, self.head, self.count = k, 0, 0
+    else:
+      self.head += k - self.first
+      self.count -= k - self.first
+      self.first = k
+
+  def _append(self, frames: NDArray[np.float32]):
+    n = min(frames.shape[1], self.capacity - self.count)
+    if self.head + self.count + n > self.frames.shape[1]:
+      self.frames[:, :self.count] = self.frames[:, self.head: self.head + self.count]
+      self.head = 0
+    self.frames[:, self.head + self.count: self.head + self.count + n] = frames[:, :n]
+    self.count += n
+
+  def update(self, timeline: AudioTimeline):
+    '''Drop the frames of released audio and compute the frames of newly
+    written audio. Call it before reading a window of the timeline.
+    '''
+    start, end = timeline.start, timeline.end
+    if start is None:
+      return
+    if (start - self.phase) % HOP_LENGTH:
+      # moved off the grid, start a new one
+      self.phase = start % HOP_LENGTH
+      self.clear()
+    self._drop(self._index(start))
+
+    k_from = self.first + self.count
+    k_to = min(self._index(end - HALF_FFT) + 1, self.first + self.capacity)
+    if k_to <= k_from:
+      return
+    lo = self._center(k_from) - HALF_FFT
+    hi = self._center(k_to - 1) + HALF_FFT
+    samples = _padded(timeline.view(start, end - start), lo - start, hi - start)
+    self._append(log_mel_frames(samples, self.n_mels))
+
+  def window(self, pos: int, data: NDArray[np.float32]) -> Optional[NDArray[np.float32]]:
+    '''Unnormalized frames of `data`, a window starting at virtual position
+    `pos`, as whisper sees it: silent after the window. Returns None if the
+    window is not on the frame grid or its head is not cached.
+    '''
+    if (pos - self.phase) % HOP_LENGTH:
+      return None
+    k0 = self._index(pos)
+    if not self.first <= k0 <= self.first + self.count:
+      return None
+    end = pos + data.size
+    k_end = -(-(end + HALF_FFT - self.phase) // HOP_LENGTH)  # frames touching the window
+    k_cached = max(min(self._index(end - HALF_FFT) + 1, self.first + self.count), k0)
+
+    # frames at the end of the window see the silence after it
+    lo = self._center(k_cached) - HALF_FFT
+    hi = self._center(k_end - 1) + HALF_FFT
+    tail = log_mel_frames(_padded(data, lo - pos, hi - pos), self.n_mels) \
+        if k_end > k_cached else np.zeros((self.n_mels, 0), dtype=np.float32)
+    i = self.head + k0 - self.first
+    return np.concatenate([self.frames[:, i: i + k_cached - k0], tail], axis=1)
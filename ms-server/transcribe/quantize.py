@@ -0,0 +1,64 @@
+from typing import Optional
+
+import os
+import logging
+import whisper
+import torch
+import torch.nn as nn
+
+default_logger = logging.getLogger(__name__)
+
+
+def _to_plain_linear(module: nn.Module):
+  # dynamic quantization only maps exact nn.Linear instances,
+  # while whisper subclasses it to cast weights on the fly
+  for name, child in module.named_children():
+    if isinstance(child, nn.Linear) and type(child) is not nn.Linear:
+      plain = nn.Linear(child.in_features, child.out_features, child.bias is not None)
+      plain.weight = child.weight
+      plain.bias = child.bias
+      setattr(module, name, plain)
+    else:
+      _to_plain_linear(child)
+
+
+def quantize_model(model: whisper.Whisper) -> whisper.Whisper:
+  '''Quantize the weights of every linear layer of a CPU model to int8.
+  Activations stay in fp32 and are quantized on the fly.
+  '''
+  model = model.float().eval()
+  _to_plain_linear(model)
+  return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def quantized_path(name: str, cache_dir: str) -> str:
+  # packed int8 weights are tied to the torch build
+  base = os.path.splitext(os.path.basename(name))[0]
+  return os.path.join(cache_dir, f'{base}.int8.torch-{torch.__version__}.pt')
+
+
+def load_quantized_model(
+    name: str,
+    cache_dir: Optional[str] = None,
+    logger: Optional[logging.Logger] = None,
+    **options
+) -> whisper.Whisper:
+  '''Load the int8 quantized model `name`, from `cache_dir` if it was
+  quantized before, and store it there otherwise.
+  '''
+  logger = logger or default_logger
+  path = quantized_path(name, cache_dir) if cache_dir else None
+  if path is not None and os.path.exists(path):
+    try:
+      return torch.load(path, map_location='cpu', weights_only=False).eval()
+    except Exception as e:
+      logger.warning(f'Failed to load quantized model {path}, quantizing again: {e!r}')
+
+  model = quantize_model(whisper.load_model(name, device='cpu', **options))
+  if path is not None:
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = path + '.tmp'
+    torch.save(model, tmp_path)
+    os.replace(tmp_path, path)
+    logger.info(f'Saved quantized model {name} to {path}.')
+  return model
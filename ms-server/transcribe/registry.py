@@ -0,0 +1,198 @@
+from typing import Optional, Dict, Any, Tuple, Set
+from dataclasses import dataclass, field
+
+import whisper
+import torch
+import gc
+import time
+import asyncio
+import logging
+import concurrent.futures
+
+from config import AppConfig
+from transcribe.quantize import load_quantized_model
+
+default_logger = logging.getLogger(__name__)
+
+# loading is kept off the inference threads
+_loader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+_run_async = lambda f, *a: asyncio.get_event_loop().run_in_executor(_loader, f, *a)
+
+ModelKey = Tuple[str, Optional[str], Tuple[Tuple[str, Any], ...]]
+
+
+def model_key(name: str, device: Optional[str] = None, **options) -> ModelKey:
+  return name, device, tuple(sorted(options.items()))
+
+
+def _tensor_bytes(value: Any) -> int:
+  if isinstance(value, torch.Tensor):
+    return value.numel() * value.element_size()
+  if isinstance(value, (tuple, list)):  # packed params of quantized layers
+    return sum(_tensor_bytes(v) for v in value)
+  return 0
+
+
+def model_size(model: torch.nn.Module) -> int:
+  '''Memory held by the weights and buffers of a model, in bytes.
+  '''
+  return sum(_tensor_bytes(v) for v in model.state_dict().values())
+
+
+def load_model_sync(
+    name: str,
+    device: Optional[str] = None,
+    quantize: bool = False,  # int8 linear layers, CPU only
+    **options
+) -> whisper.Whisper:
+  if quantize:
+    return load_quantized_model(name, AppConfig.QuantizedModelDir, **options)
+  return whisper.load_model(name, device=device, **options)
+
+
+def unload_model_sync(model: whisper.Whisper):
+  del model
+  if torch.cuda.is_available():
+    torch.cuda.empty_cache()
+  gc.collect()
+
+
+@dataclass
+class _Entry:
+  key: ModelKey
+  loading: asyncio.Future
+  model: Optional[whisper.Whisper] = None
+  size: int = 0
+  refs: int = 0
+  last_used: float = field(default_factory=time.monotonic)
+
+
+class ModelRegistry:
+  '''Process-wide cache of loaded Whisper models.
+
+  Models are shared by every worker that asks for the same name, device and
+  load options, and are reference counted. Idle models stay loaded so the
+  next meeting starts warm, until the memory budget forces the least
+  recently used ones out. Without a budget, only preloaded models stay
+  loaded once idle.
+  '''
+
+  def __init__(
+      self,
+      memory_budget: int = 0,  # in bytes, 0 to keep only preloaded models idle
+      logger: Optional[logging.Logger] = None,
+  ):
+    self.memory_budget = memory_budget
+    self.logger = logger or default_logger
+    self.entries: Dict[ModelKey, _Entry] = {}
+    self.keys: Dict[int, ModelKey] = {}  # id(model) -> key
+    self.pinned: Set[ModelKey] = set()  # preloaded
+    self.lock = asyncio.Lock()
+
+  @property
+  def memory_usage(self) -> int:
+    return sum(e.size for e in self.entries.values())
+
+  async def acquire(self, name: str, device: Optional[str] = None, **options) -> whisper.Whisper:
+    key = model_key(name, device, **options)
+    async with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        entry = _Entry(key, asyncio.get_event_loop().create_future())
+        self.entries[key] = entry
+        load = True
+      else:
+        load = False
+      entry.refs += 1
+
+    if load:
+      try:
+        model = await _run_async(lambda: load_model_sync(name, device, **options))
+      except BaseException as e:
+        async with self.lock:
+          self.entries.pop(key, None)
+        if isinstance(e, asyncio.CancelledError):
+          entry.loading.cancel()
+        else:
+          self.logger.error(f'Failed to load model {name}: {e!r}')
+          entry.loading.set_exception(e)
+          entry.loading.exception()  # raised here, and to whoever waits on it
+        raise
+      async with self.lock:
+        entry.model = model
+        entry.size = model_size(model)
+        self.keys[id(model)] = key
+        entry.loading.set_result(model)
+        evicted = self._pick_evicted()
+      await self._unload(evicted)
+    else:
+      try:
+        await asyncio.shield(entry.loading)
+      except BaseException:
+        entry.refs -= 1
+        raise
+
+    entry.last_used = time.monotonic()
+    return entry.model
+
+  async def release(self, model: whisper.Whisper):
+    async with self.lock:
+      key = self.keys.get(id(model))
+      entry = self.entries.get(key) if key is not None else None
+      if entry is None:
+        return
+      entry.refs = max(entry.refs - 1, 0)
+      entry.last_used = time.monotonic()
+      evicted = self._pick_evicted()
+    await self._unload(evicted)
+
+  async def preload(self, name: str, device: Optional[str] = None, **options):
+    '''Load a model and keep it idle in the registry.
+    '''
+    self.pinned.add(model_key(name, device, **options))
+    model = await self.acquire(name, device, **options)
+    await self.release(model)
+
+  async def clear(self):
+    '''Unload every idle model.
+    '''
+    async with self.lock:
+      evicted = [e for e in self.entries.values() if e.refs == 0 and e.model is not None]
+      for e in evicted:
+        self._remove(e)
+    await self._unload(evicted)
+
+  def _remove(self, entry: _Entry):
+    self.entries.pop(entry.key, None)
+    self.keys.pop(id(entry.model), None)
+
+  def _pick_evicted(self):
+    # least recently used idle models beyond the budget
+    evicted = []
+    idle = sorted(
+        (e for e in self.entries.values() if e.refs == 0 and e.model is not None),
+        key=lambda e: e.last_used
+    )
+    if self.memory_budget <= 0:
+      for e in idle:
+        if e.key not in self.pinned:
+          self._remove(e)
+          evicted.append(e)
+      return evicted
+    usage = self.memory_usage
+    for e in idle:
+      if usage <= self.memory_budget:
+        break
+      usage -= e.size
+      self._remove(e)
+      evicted.append(e)
+    return evicted
+
+  async def _unload(self, evicted):
+    for e in evicted:
+      self.logger.info(f'Evicting model {e.key[0]} ({e.size >> 20} MiB).')
+      model, e.model = e.model, None
+      await _run_async(unload_model_sync, model)
+
+
+model_registry = ModelRegistry(AppConfig.ModelMemoryBudget << 20)
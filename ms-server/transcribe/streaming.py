@@ -0,0 +1,56 @@
+import re
+from typing import List, Tuple
+from dataclasses import dataclass
+
+_NORMALIZE_REGEX = re.compile(r'[\s\.,!?;:，。！？、；：…「」『』"\']+')
+
+
+@dataclass
+class Word:
+
+  start: int = 0  # ms
+  end: int = 0  # ms
+  text: str = ''
+  segment: int = 0
+
+
+def normalize_word(text: str):
+  return _NORMALIZE_REGEX.sub('', text).lower()
+
+
+class LocalAgreement:
+  '''Commits the longest word prefix on which two consecutive hypotheses
+  agree. The tail after that prefix stays unstable and is compared with
+  the next hypothesis.
+  '''
+
+  def __init__(self, prompt_length: int = 200):
+    self.prompt_length = prompt_length
+    self.hypothesis: List[Word] = []
+    self.committed_text = ''
+
+  @property
+  def prompt(self) -> str:
+    '''Tail of the committed text, fed back as the decoding prompt.
+    '''
+    return self.committed_text[-self.prompt_length:]
+
+  def update(self, words: List[Word], commit_all: bool = False) -> Tuple[List[Word], List[Word]]:
+    '''Return the newly committed words and the unstable tail.
+    '''
+    if commit_all:
+      count = len(words)
+    else:
+      count = 0
+      for prev, curr in zip(self.hypothesis, words):
+        if normalize_word(prev.text) != normalize_word(curr.text):
+          break
+        count += 1
+
+    committed, tail = words[:count], words[count:]
+    self.hypothesis = tail
+    self.committed_text = (self.committed_text + ''.join(w.text for w in committed))[-self.prompt_length:]
+    return committed, tail
+
+  def reset(self):
+    self.hypothesis = []
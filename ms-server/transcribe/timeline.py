@@ -0,0 +1,170 @@
+from typing import Optional, Tuple, Deque
+from collections import deque
+
+import numpy as np
+from numpy.typing import NDArray
+
+
+class AudioTimeline:
+  '''Fixed-capacity float32 ring buffer addressed by millisecond timestamps.
+
+  Samples are stored twice (the buffer is mirrored) so that any window no
+  longer than the capacity can be read as one contiguous view. Released
+  slots are zeroed, so gaps are implicitly silent and overlapping chunks
+  are mixed in place by adding them to what is already there.
+
+  Gaps longer than `gap_max` milliseconds are not kept in the buffer. They
+  are recorded as breaks instead, and the audio after a break is stored
+  right behind the audio before it.
+  '''
+
+  def __init__(
+      self,
+      capacity: int,  # in samples
+      one_ms_sample: int = 16,
+      gap_max: int = 2000,  # in ms
+  ):
+    self.capacity = capacity
+    self.one_ms_sample = one_ms_sample
+    self.gap_max = gap_max
+    self.buffer = np.zeros((capacity * 2,), dtype=np.float32)
+
+    # positions are sample indices on a virtual axis without long gaps;
+    # the real sample index is the virtual one plus an offset
+    self.start: Optional[int] = None
+    self.end: Optional[int] = None
+    self.offset = 0  # offset used for incoming chunks
+    self.read_offset = 0  # offset in effect at `start`
+    self.breaks: Deque[Tuple[int, int]] = deque()  # (virtual position, new offset)
+
+    self.updated = False
+    self.written = 0  # samples written since the counter was reset
+    self.dropped = 0  # samples overwritten before being read
+
+  @property
+  def size(self) -> int:
+    return 0 if self.start is None else self.end - self.start
+
+  @property
+  def empty(self) -> bool:
+    return self.size == 0
+
+  @property
+  def start_time(self) -> Optional[int]:
+    if self.start is None:
+      return None
+    return (self.start + self.read_offset) // self.one_ms_sample
+
+  # raw access
+
+  def _apply(self, pos: int, data: Optional[NDArray[np.float32]], length: int):
+    # add `data` to, or zero if None, `length` slots starting from `pos`
+    cap = self.capacity
+    i = pos % cap
+    k = min(length, cap - i)
+    if data is None:
+      self.buffer[i: i + length] = 0
+      self.buffer[i + cap: i + cap + k] = 0
+      if length > k:
+        self.buffer[: length - k] = 0
+    else:
+      self.buffer[i: i + length] += data
+      self.buffer[i + cap: i + cap + k] += data[:k]
+      if length > k:
+        self.buffer[: length - k] += data[k:]
+
+  def view(self, pos: int, length: int) -> NDArray[np.float32]:
+    '''Contiguous view of `length` samples from virtual position `pos`.
+    The view is only valid until the next write or release.
+    '''
+    i = pos % self.capacity
+    return self.buffer[i: i + length]
+
+  # write & release
+
+  def write(self, time: int, sample: NDArray[np.float32]) -> Optional[int]:
+    '''Mix a chunk starting at `time` (in ms) into the timeline. Returns the
+    virtual position it was written at, or None if nothing was written.
+    '''
+    size = sample.size
+    if size == 0:
+      return None
+    pos = time * self.one_ms_sample - self.offset
+
+    if self.start is None:
+      self.start = self.end = pos
+    elif pos - self.end > self.gap_max * self.one_ms_sample:
+      # long gap: collapse it into a break
+      delta = pos - self.end
+      self.offset += delta
+      pos = self.end
+      if self.start == self.end:
+        self.read_offset = self.offset
+      else:
+        self.breaks.append((pos, self.offset))
+
+    if pos < self.start:  # the head is already consumed
+      if pos + size <= self.start:
+        return None
+      sample = sample[self.start - pos:]
+      size = sample.size
+      pos = self.start
+
+    if size > self.capacity:
+      sample = sample[size - self.capacity:]
+      pos += size - self.capacity
+      size = self.capacity
+
+    overflow = pos + size - self.start - self.capacity
+    if overflow > 0:  # overwrite the oldest samples
+      self.dropped += min(overflow, self.end - self.start)
+      self.release(self.start + overflow)
+
+    if pos > self.end:  # short gap, already zeroed
+      self.end = pos
+
+    self._apply(pos, sample, size)
+    self.end = max(self.end, pos + size)
+    self.updated = True
+    self.written += size
+    return pos
+
+  def release(self, pos: int):
+    '''Discard all samples before virtual position `pos`.
+    '''
+    if self.start is None or pos <= self.start:
+      return
+    length = min(pos - self.start, self.capacity)
+    self._apply(self.start, None, length)
+    self.start = pos
+    if self.end < pos:
+      self.end = pos
+    while self.breaks and self.breaks[0][0] <= pos:
+      _, self.read_offset = self.breaks.popleft()
+
+  def clear(self):
+    '''Discard all samples. The next write anchors the timeline again, so
+    chunks timed before the discarded ones are kept.
+    '''
+    if self.start is not None:
+      self.release(self.end)
+    self.start = self.end = None
+    self.breaks.clear()
+    self.offset = self.read_offset = 0
+    self.updated = False
+
+  # read
+
+  def window(self, max_count: int) -> Tuple[int, NDArray[np.float32], bool]:
+    '''Return the start time (in ms) and a contiguous view of at most
+    `max_count` samples from the read position, and whether the window
+    is cut by a break.
+    '''
+    if self.start is None:
+      return 0, self.buffer[:0], False
+    limit = min(self.end, self.start + min(max_count, self.capacity))
+    cut = False
+    if self.breaks and self.breaks[0][0] <= limit:
+      limit = self.breaks[0][0]
+      cut = True
+    return self.start_time, self.view(self.start, limit - self.start), cut
@@ -0,0 +1,102 @@
+import abc
+from typing import Optional, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+
+class VoiceActivityDetector(abc.ABC):
+
+  frame_size: int = 480  # in samples
+
+  @abc.abstractmethod
+  def detect(self, data: NDArray[np.float32]) -> NDArray[np.bool_]:
+    '''Return one flag per complete frame of `data`, True for speech.
+    '''
+    pass
+
+  def speech_range(self, data: NDArray[np.float32], padding: int = 0) -> Optional[Tuple[int, int]]:
+    '''Return the sample range from the first to the last speech frame,
+    widened by `padding` samples, or None if there is no speech.
+    '''
+    flags = self.detect(data)
+    speech = np.flatnonzero(flags)
+    if speech.size == 0:
+      return None
+    start = max(int(speech[0]) * self.frame_size - padding, 0)
+    end = data.size if speech[-1] == flags.size - 1 else \
+        min((int(speech[-1]) + 1) * self.frame_size + padding, data.size)
+    return start, end
+
+
+class EnergyVAD(VoiceActivityDetector):
+  '''Frame energy + zero-crossing detector with hysteresis.
+
+  A frame turns speech on when it is loud enough (above both an absolute
+  threshold and the noise floor plus a margin) and does not cross zero too
+  often, and turns it off when it falls below a lower threshold. Frames in
+  between keep the previous state. Speech is held for `hangover` frames
+  after it ends.
+
+  The noise floor is tracked across windows from the frames judged not
+  speech, since a window of speech alone says nothing about the noise.
+  It never goes above `noise_max`.
+  '''
+
+  def __init__(
+      self,
+      frame_size: int = 480,  # 30ms at 16kHz
+      threshold_on: float = -42,  # dBFS
+      threshold_off: float = -48,  # dBFS
+      noise_margin: float = 8,  # dB above the noise floor
+      noise_percentile: float = 10,
+      noise_max: float = -40,  # dBFS
+      noise_adapt: float = 0.2,  # weight of each window in the tracked floor
+      zcr_max: float = 0.4,  # crossings per sample
+      hangover: int = 8,  # in frames
+  ):
+    self.frame_size = frame_size
+    self.threshold_on = threshold_on
+    self.threshold_off = threshold_off
+    self.noise_margin = noise_margin
+    self.noise_percentile = noise_percentile
+    self.noise_max = noise_max
+    self.noise_adapt = noise_adapt
+    self.noise_floor: Optional[float] = None  # in dBFS, tracked across windows
+    self.zcr_max = zcr_max
+    self.hangover = hangover
+
+  def detect(self, data: NDArray[np.float32]) -> NDArray[np.bool_]:
+    n = data.size // self.frame_size
+    if n == 0:
+      return np.zeros((0,), dtype=np.bool_)
+    frames = data[:n * self.frame_size].reshape(n, self.frame_size)
+
+    energy = np.einsum('ij,ij->i', frames, frames) / self.frame_size
+    level = 10 * np.log10(energy + 1e-12)
+    signs = np.signbit(frames)
+    zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / self.frame_size
+
+    noise_floor = np.percentile(level, self.noise_percentile)
+    if self.noise_floor is not None:
+      noise_floor = min(noise_floor, self.noise_floor)
+    noise_floor = min(noise_floor, self.noise_max)
+    delta_on = max(self.threshold_on, noise_floor + self.noise_margin) - self.threshold_on
+    on = (level >= self.threshold_on + delta_on) & (zcr <= self.zcr_max)
+    off = level < self.threshold_off + delta_on
+
+    # hysteresis: undecided frames take the state of the last decided one
+    decided = np.where(on | off, np.arange(n), -1)
+    np.maximum.accumulate(decided, out=decided)
+    speech = (decided >= 0) & on[np.maximum(decided, 0)]
+
+    if self.hangover > 0:
+      held = np.convolve(speech, np.ones((self.hangover + 1,), dtype=np.int32))[:n]
+      speech = held > 0
+
+    quiet = level[~speech]
+    if quiet.size > 0:
+      estimate = float(np.median(quiet))
+      self.noise_floor = estimate if self.noise_floor is None else \
+          self.noise_floor + self.noise_adapt * (estimate - self.noise_floor)
+    return speech
@@ -0,0 +1,44 @@
+from typing import Optional
+
+import whisper
+
+from transcribe.w_whisper import WhisperWorker
+from transcribe.registry import model_registry
+from transcribe.decoding import ReducedContextModel
+
+
+class WhisperCascadeWorker(WhisperWorker):
+  '''WhisperWorker with two models. The small `model` transcribes every
+  pass and produces the partial results, and `final_model` re-transcribes
+  only the span about to be committed, once per segment.
+  '''
+
+  def __init__(
+      self,
+      model: str,
+      final_model: str,
+      **kwargs,
+  ):
+    super().__init__(model, **kwargs)
+    self.final_params = final_model
+    self.final_whisper: Optional[whisper.Whisper] = None
+
+  async def init_model(self):
+    await super().init_model()
+    self.final_whisper = await model_registry.acquire(self.final_params, **self.load_options)
+    self.final_model = self.final_whisper
+    if self.audio_ctx_bucket > 0:
+      self.final_model = ReducedContextModel(self.final_whisper, self.audio_ctx_bucket)
+
+  def context_fallbacks(self) -> int:
+    fallbacks = super().context_fallbacks()
+    if isinstance(self.final_model, ReducedContextModel):
+      fallbacks += self.final_model.fallbacks
+    return fallbacks
+
+  async def close_model(self):
+    self.final_model = None
+    final_whisper, self.final_whisper = self.final_whisper, None
+    if final_whisper is not None:
+      await model_registry.release(final_whisper)
+    await super().close_model()
@@ -0,0 +1,249 @@
+from typing import Optional, Dict, Any, List, Tuple
+
+import asyncio
+import logging
+import threading
+import multiprocessing as mp
+from multiprocessing.connection import Connection
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from numpy.typing import NDArray
+
+from transcribe.w_whisper import WhisperWorker, MAX_SAMPLE_COUNT, _run_async
+
+default_logger = logging.getLogger(__name__)
+
+_EMPTY_RESULT = {'text': '', 'segments': [], 'language': ''}
+
+
+def _serve(conn: Connection, shm_name: str, model: str, num_threads: int, audio_ctx_bucket: int, quantize: bool):
+  # entry point of the worker process
+  import torch
+  from transcribe.registry import load_model_sync
+  from transcribe.language import detect_language
+  from transcribe.decoding import ReducedContextModel
+
+  shm = SharedMemory(name=shm_name)
+  try:
+    if num_threads > 0:
+      torch.set_num_threads(num_threads)
+    whisper_model = load_model_sync(model, quantize=quantize)
+    if audio_ctx_bucket > 0:
+      whisper_model = ReducedContextModel(whisper_model, audio_ctx_bucket)
+    conn.send(('ready', None))
+
+    while True:
+      command, payload = conn.recv()
+      if command == 'transcribe':
+        size, options = payload
+        audio = np.ndarray((size,), dtype=np.float32, buffer=shm.buf)
+        try:
+          conn.send(('done', whisper_model.transcribe(audio, **options)))
+        except Exception as e:
+          conn.send(('error', repr(e)))
+        del audio
+      elif command == 'detect':
+        size, candidates = payload
+        audio = np.ndarray((size,), dtype=np.float32, buffer=shm.buf)
+        try:
+          conn.send(('done', detect_language(whisper_model, audio, candidates)))
+        except Exception as e:
+          conn.send(('error', repr(e)))
+        del audio
+      elif command == 'ping':
+        conn.send(('pong', None))
+      elif command == 'close':
+        break
+  except (EOFError, KeyboardInterrupt):
+    pass
+  finally:
+    shm.close()
+
+
+class ProcessModel:
+  '''Proxy of a Whisper model hosted in a dedicated worker process.
+
+  Audio is handed over through shared memory and results come back over a
+  pipe. `transcribe` blocks the calling thread, so call it from an
+  executor. A dead worker process is restarted on the next call.
+  '''
+
+  schedules_inference = True
+
+  def __init__(
+      self,
+      model: str,
+      num_threads: int = 0,
+      audio_ctx_bucket: int = 0,
+      quantize: bool = False,
+      max_sample_count: int = MAX_SAMPLE_COUNT,
+      start_timeout: float = 600,
+      logger: Optional[logging.Logger] = None,
+  ):
+    self.model = model
+    self.num_threads = num_threads
+    self.audio_ctx_bucket = audio_ctx_bucket
+    self.quantize = quantize
+    self.max_sample_count = max_sample_count
+    self.start_timeout = start_timeout
+    self.logger = logger or default_logger
+
+    self.shm: Optional[SharedMemory] = None
+    self.process: Optional[mp.Process] = None
+    self.conn: Optional[Connection] = None
+    self.lock = threading.Lock()
+    self.restarts = 0
+
+  # lifecycle
+
+  def _start(self):
+    if self.shm is None:
+      self.shm = SharedMemory(create=True, size=self.max_sample_count * 4)
+    ctx = mp.get_context('spawn')
+    self.conn, child_conn = ctx.Pipe()
+    self.process = ctx.Process(
+        target=_serve,
+        args=(child_conn, self.shm.name, self.model, self.num_threads, self.audio_ctx_bucket, self.quantize),
+        daemon=True,
+    )
+    self.process.start()
+    child_conn.close()
+    if not self.conn.poll(self.start_timeout):
+      self._stop()
+      raise RuntimeError(f'Transcription process did not start in {self.start_timeout}s.')
+    status, _ = self.conn.recv()
+    if status != 'ready':
+      self._stop()
+      raise RuntimeError(f'Transcription process failed to start: {status}')
+
+  def _stop(self, timeout: float = 5):
+    if self.conn is not None:
+      try:
+        self.conn.send(('close', None))
+      except (OSError, EOFError):
+        pass
+      self.conn.close()
+      self.conn = None
+    if self.process is not None:
+      self.process.join(timeout)
+      if self.process.is_alive():
+        self.process.kill()
+        self.process.join()
+      self.process = None
+
+  def _restart(self):
+    self.logger.warning(f'Restarting transcription process of model {self.model}.')
+    self.restarts += 1
+    self._stop(0)
+    self._start()
+
+  def start(self):
+    with self.lock:
+      self._start()
+
+  def stop(self):
+    with self.lock:
+      self._stop()
+      if self.shm is not None:
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+  def alive(self) -> bool:
+    return self.process is not None and self.process.is_alive()
+
+  def check_health(self, timeout: float = 5) -> bool:
+    '''Ping the worker process and restart it if it does not answer.
+    A busy worker only needs to be alive.
+    '''
+    if not self.lock.acquire(blocking=False):
+      return self.alive()
+    try:
+      try:
+        self.conn.send(('ping', None))
+        if self.conn.poll(timeout) and self.conn.recv()[0] == 'pong':
+          return True
+      except (OSError, EOFError, AttributeError):
+        pass
+      self._restart()
+      return False
+    finally:
+      self.lock.release()
+
+  # inference
+
+  def _request(self, command: str, audio: NDArray[np.float32], argument: Any, default: Any):
+    size = audio.size
+    if size > self.max_sample_count:
+      raise ValueError(f'Audio too long: {size} > {self.max_sample_count} samples.')
+
+    with self.lock:
+      for retry in (False, True):
+        if not self.alive():
+          self._restart()
+        np.ndarray((size,), dtype=np.float32, buffer=self.shm.buf)[:] = audio
+        try:
+          self.conn.send((command, (size, argument)))
+          status, payload = self.conn.recv()
+        except (OSError, EOFError):
+          # the process crashed in the middle of the pass
+          if retry:
+            self._restart()
+          continue
+        if status == 'done':
+          return payload
+        self.logger.error(f'Transcription process failed on {command}: {payload}')
+        break
+    return default
+
+  def transcribe(self, audio: NDArray[np.float32], **options) -> Dict[str, Any]:
+    return self._request('transcribe', audio, options, dict(_EMPTY_RESULT))
+
+  def detect_audio_language(self, audio: NDArray[np.float32], candidates: Optional[List[str]] = None) -> Tuple[str, float]:
+    return self._request('detect', audio, candidates, ('', 0.0))
+
+
+class WhisperProcessWorker(WhisperWorker):
+  '''WhisperWorker whose model runs in a dedicated process, so inference
+  does not compete with the event loop for the GIL.
+  '''
+
+  def __init__(
+      self,
+      model: str,
+      num_threads: int = 0,
+      health_interval: float = 10,  # in seconds
+      **kwargs,
+  ):
+    super().__init__(model, **kwargs)
+    # the child process has its own model, which neither takes cached mel
+    # frames from this process nor shares batches with other workers
+    if self.use_mel_cache or self.batching:
+      default_logger.warning('MelCache and BatchInference are not supported with TranscriptionProcess, ignored.')
+      self.use_mel_cache = False
+      self.batching = False
+    self.num_threads = num_threads
+    self.health_interval = health_interval
+    self.health_task: Optional[asyncio.Task] = None
+
+  async def _check_health(self):
+    while self.model is not None:
+      await asyncio.sleep(self.health_interval)
+      if self.model is not None:
+        await _run_async(self.model.check_health)
+
+  async def init_model(self):
+    proxy = ProcessModel(
+        self.init_params, self.num_threads, self.audio_ctx_bucket, bool(self.load_options.get('quantize')))
+    await _run_async(proxy.start)
+    self.model = proxy
+    self.health_task = asyncio.create_task(self._check_health())
+
+  async def close_model(self):
+    if self.health_task is not None:
+      self.health_task.cancel()
+      self.health_task = None
+    proxy, self.model = self.model, None
+    if proxy is not None:
+      await _run_async(proxy.stop)
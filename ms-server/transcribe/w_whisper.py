@@ -1,22 +1,33 @@
-from typing import Optional, List, Dict, Any, Tuple, Union
+from typing import Optional, List, Dict, Any, Tuple, Union, Iterable
 
 import whisper
 import torch
-import gc
+from whisper.audio import HOP_LENGTH
 import numpy as np
 from numpy.typing import NDArray
 import asyncio
-import concurrent.futures
+from dataclasses import dataclass, field
 
 from transcribe.worker import TranscriptionResult, TranscribeWorker
-
-_executor = concurrent.futures.ThreadPoolExecutor()
-_run_async = lambda f, *a: asyncio.get_event_loop().run_in_executor(_executor, f, *a)
+from transcribe.timeline import AudioTimeline
+from transcribe.mel import MelCache
+from transcribe.registry import model_registry
+from transcribe.executor import Priority, inference_executor
+from transcribe.decoding import ReducedContextModel
+from transcribe.batch import BatchInferenceService, acquire_service, release_service
+from transcribe.vad import VoiceActivityDetector
+from transcribe.streaming import LocalAgreement, Word
+from transcribe.language import LanguageTracker, detect_language
+
+# for waiting on proxies that schedule inference themselves
+_run_async = lambda f, *a: asyncio.get_event_loop().run_in_executor(None, f, *a)
 
 ONE_MS_SAMPLE = 16
 SAMPLE_RATE = ONE_MS_SAMPLE * 1000  # 1s
 MAX_SAMPLE_COUNT = SAMPLE_RATE * 20  # 20s
 GAP_FILL_MAX = 2000  # ms
+VAD_PADDING = 200  # ms
+TIMELINE_CAPACITY = MAX_SAMPLE_COUNT * 3
 
 
 def convert_segment(s: Dict[str, Any], complete: bool, start_time: int, lang: str = ''):
@@ -29,6 +40,104 @@ def convert_segment(s: Dict[str, Any], complete: bool, start_time: int, lang: st
   )
 
 
+async def run_model(
+    model: whisper.Whisper,
+    data: NDArray,
+    language: Optional[LanguageTracker] = None,
+    time: int = 0,
+    mel: Optional[NDArray] = None,  # unnormalized log-mel frames of data
+    priority: Priority = Priority.PARTIAL,
+    **options
+) -> Dict[str, Any]:
+  if getattr(model, 'schedules_inference', False):
+    run = _run_async
+    if getattr(model, 'accepts_priority', False):
+      options['priority'] = priority
+  else:
+    run = lambda f, *a: inference_executor.run(f, *a, priority=priority)
+  if mel is not None and getattr(model, 'accepts_mel', False):
+    options['mel'] = mel
+  if language is not None:
+    if language.language is None:
+      lang, probability = await run(
+          detect_language, model, data, language.candidates)
+      if lang:
+        language.pin(lang, probability, time)
+    if language.language is not None:
+      options['language'] = language.language
+
+  raw_result = await run(
+      lambda: model.transcribe(
+          data,
+          fp16=torch.cuda.is_available(),
+          **options
+      ))
+
+  if language is not None:
+    language.observe(raw_result, time)
+  return raw_result
+
+
+@dataclass
+class DecodingProfile:
+  '''Decoding options for passes whose output may still change (partial)
+  and for the span about to be committed (final). A final of None keeps
+  the partial output.
+  '''
+  partial: Dict[str, Any] = field(default_factory=dict)
+  final: Optional[Dict[str, Any]] = None
+
+
+_GREEDY = dict(temperature=0.0, beam_size=None, best_of=None)
+
+DECODING_PROFILES: Dict[str, Optional[DecodingProfile]] = {
+    # whisper's defaults: up to 6 temperature fallbacks on every pass
+    'default': None,
+    # greedy everywhere
+    'fast': DecodingProfile(partial=_GREEDY),
+    # beam search with a bounded fallback budget on commit, which costs one
+    # more decode of every committed span
+    'balanced': DecodingProfile(
+        partial=_GREEDY,
+        final=dict(temperature=(0.0, 0.4), beam_size=5, best_of=5),
+    ),
+    'accurate': DecodingProfile(
+        partial=_GREEDY,
+        final=dict(temperature=(0.0, 0.2, 0.4, 0.6), beam_size=5, best_of=5),
+    ),
+}
+
+
+async def finalize_span(
+    model: whisper.Whisper,
+    data: NDArray,  # the span about to be committed
+    results: List[TranscriptionResult],  # partial decoding of the span
+    start_time: int = 0,
+    profile: Optional[DecodingProfile] = None,
+    language: Optional[LanguageTracker] = None,
+    final_model: Optional[whisper.Whisper] = None,
+    **options
+) -> List[TranscriptionResult]:
+  '''Re-decode a span with the final options of the profile, by
+  `final_model` if given. Falls back to `results` if there is no final
+  decoding or it yields nothing.
+  '''
+  final_options = profile.final if profile is not None else None
+  if final_model is None and final_options is None:
+    return results
+  if not results or data.size == 0:
+    return results
+  raw_result = await run_model(
+      final_model or model, data, language, start_time,
+      priority=Priority.FINAL,
+      **{**options, **(final_options or {})})
+  segments = raw_result['segments']
+  if not segments:
+    return results
+  return [convert_segment(s, True, start_time, raw_result['language'])
+          for s in segments]
+
+
 async def transcribe_and_segment(
     model: whisper.Whisper,
     data: NDArray,  # float type with -1 to 1
@@ -36,14 +145,18 @@ async def transcribe_and_segment(
     force_complete: bool = False,
     t_fc_gap: float = 1,
     t_fc_length: float = 10,
+    duration: Optional[float] = None,  # seconds, covering trimmed silence
+    language: Optional[LanguageTracker] = None,
+    profile: Optional[DecodingProfile] = None,
+    final_model: Optional[whisper.Whisper] = None,
+    mel: Optional[NDArray] = None,
 ):
   # run transcription asynchrously
-  duration = data.size / SAMPLE_RATE  # seconds
-  raw_result: List[Dict[str, Any]] = await _run_async(
-      lambda: model.transcribe(
-          data,
-          fp16=torch.cuda.is_available(),
-      ))
+  if duration is None:
+    duration = data.size / SAMPLE_RATE  # seconds
+  raw_result = await run_model(
+      model, data, language, start_time, mel,
+      **(profile.partial if profile else {}))
   segments = raw_result['segments']
   lang = raw_result['language']
 
@@ -68,6 +181,13 @@ async def transcribe_and_segment(
   # handle complete segments
   results = [convert_segment(s, True, start_time, lang)
              for s in complete_segments]
+  if results:
+    if incomplete_segment is None:
+      results = await finalize_span(
+          model, data, results, start_time, profile, language, final_model, mel=mel)
+    else:
+      results = await finalize_span(
+          model, data[:sample_retain], results, start_time, profile, language, final_model)
 
   incomplete_result = convert_segment(incomplete_segment, False, start_time, lang) \
       if incomplete_segment else None
@@ -75,46 +195,212 @@ async def transcribe_and_segment(
   return results, incomplete_result, sample_retain
 
 
+def group_words(words: List[Word], complete: bool, lang: str = ''):
+  # one result per run of words from the same segment
+  results: List[TranscriptionResult] = []
+  last_segment = None
+  for w in words:
+    if results and w.segment == last_segment:
+      results[-1].end = w.end
+      results[-1].text += w.text
+    else:
+      results.append(TranscriptionResult(
+          partial=not complete,
+          start=w.start,
+          end=w.end,
+          text=w.text,
+          lang=lang
+      ))
+    last_segment = w.segment
+  return results
+
+
+async def transcribe_streaming(
+    model: whisper.Whisper,
+    data: NDArray,  # float type with -1 to 1
+    agreement: LocalAgreement,
+    start_time: int = 0,
+    force_complete: bool = False,
+    t_fc_gap: float = 1,
+    t_fc_length: float = 10,
+    duration: Optional[float] = None,  # seconds, covering trimmed silence
+    language: Optional[LanguageTracker] = None,
+    profile: Optional[DecodingProfile] = None,
+    final_model: Optional[whisper.Whisper] = None,
+    mel: Optional[NDArray] = None,
+):
+  '''Transcribe the retained window with the committed text as prompt and
+  commit the words two consecutive passes agree on. Only the unstable tail
+  is retained for the next pass.
+  '''
+  if duration is None:
+    duration = data.size / SAMPLE_RATE  # seconds
+  prompt = agreement.prompt or None
+  raw_result = await run_model(
+      model, data, language, start_time, mel,
+      initial_prompt=prompt,
+      condition_on_previous_text=False,
+      word_timestamps=True,
+      **(profile.partial if profile else {})
+  )
+  lang = raw_result['language']
+  words = [
+      Word(
+          start=int(w['start'] * 1000) + start_time,
+          end=int(w['end'] * 1000) + start_time,
+          text=w['word'],
+          segment=i,
+      )
+      for i, s in enumerate(raw_result['segments'])
+      for w in s.get('words', [])
+  ]
+
+  # commit everything if the speech is over or the window is too long
+  commit_all = force_complete or not words or \
+      duration - (words[-1].end - start_time) / 1000 >= t_fc_gap or \
+      (words[-1].end - words[0].start) / 1000 > t_fc_length or \
+      data.size >= MAX_SAMPLE_COUNT
+  committed, tail = agreement.update(words, commit_all)
+
+  if tail:
+    last_timestamp = (committed[-1].end if committed else tail[0].start) - start_time
+    sample_retain = max(min(data.size, last_timestamp * ONE_MS_SAMPLE), 0)
+  else:
+    sample_retain = data.size
+
+  results = group_words(committed, True, lang)
+  if results:
+    span = data[:max(min(data.size, (committed[-1].end - start_time) * ONE_MS_SAMPLE), 0)]
+    results = await finalize_span(
+        model, span, results, start_time, profile, language, final_model,
+        mel=mel if span.size == data.size else None,
+        initial_prompt=prompt,
+        condition_on_previous_text=False,
+    )
+  incomplete_result = TranscriptionResult(
+      partial=True,
+      start=tail[0].start,
+      end=tail[-1].end,
+      text=''.join(w.text for w in tail),
+      lang=lang
+  ) if tail else None
+
+  return results, incomplete_result, sample_retain
+
+
 class WhisperWorker(TranscribeWorker):
 
   def __init__(
           self,
-          model: str):
+          model: str,
+          vad: Optional[VoiceActivityDetector] = None,
+          streaming: bool = False,
+          language: Optional[LanguageTracker] = None,
+          profile: Optional[DecodingProfile] = None,
+          audio_ctx_bucket: int = 0,
+          batching: bool = False,
+          mel_cache: bool = False,
+          quantize: bool = False,
+          buffer_duration: float = TIMELINE_CAPACITY / SAMPLE_RATE):  # in seconds
 
     self.model: Optional[whisper.Whisper] = None
     self.init_params: str = model
-    self.queue = asyncio.Queue(maxsize=65536)
+    self.load_options: Dict[str, Any] = dict(quantize=True) if quantize else {}
+    self.vad = vad
+    self.agreement = LocalAgreement() if streaming else None
+    self.language = language
+    self.profile = profile
+    self.audio_ctx_bucket = audio_ctx_bucket
+    self.reduced_model: Optional[ReducedContextModel] = None
+    self.batching = batching
+    self.batch_service: Optional[BatchInferenceService] = None
+    self.use_mel_cache = mel_cache
+    self.mel_cache: Optional[MelCache] = None
+    self.final_model: Optional[whisper.Whisper] = None  # re-decodes committed spans
+    self.timeline = AudioTimeline(
+        max(int(buffer_duration * SAMPLE_RATE), MAX_SAMPLE_COUNT), ONE_MS_SAMPLE, GAP_FILL_MAX)
+    self.partial_pending = False  # the head of the timeline has a partial result
+    self.epoch = 0  # new utterances since the worker started
     self.lock = asyncio.Lock()
 
-    self.last_element: Optional[Tuple[int, NDArray[np.float32]]] = None
-
   async def init_model(self):
-    self.model = await _run_async(lambda: whisper.load_model(self.init_params))
-
-  def close_model_sync(self):
-    del self.model
-    if torch.cuda.is_available():
-      torch.cuda.empty_cache()
-    gc.collect()
-    self.model = None
+    self.model = await model_registry.acquire(self.init_params, **self.load_options)
+    if self.use_mel_cache:
+      # cached frames are only consumed by the in-process decoding path
+      self.mel_cache = MelCache(self.timeline.capacity // HOP_LENGTH + 3, self.model.dims.n_mels)
+    if self.batching:
+      self.batch_service = acquire_service(
+          self.model, bucket=self.audio_ctx_bucket)
+    elif self.audio_ctx_bucket > 0 or self.mel_cache is not None:
+      self.reduced_model = ReducedContextModel(self.model, self.audio_ctx_bucket)
 
   async def close_model(self):
-    await _run_async(self.close_model_sync)
+    self.reduced_model = None
+    self.mel_cache = None
+    service, self.batch_service = self.batch_service, None
+    if service is not None:
+      await _run_async(release_service, service)
+    model, self.model = self.model, None
+    if model is not None:
+      await model_registry.release(model)
+
+  def _write(self, time: int, sample: NDArray[np.float32]):
+    pos = self.timeline.write(time, sample)
+    if pos is not None and self.mel_cache is not None:
+      self.mel_cache.invalidate(pos)
 
   async def enqueue_chunk(self, time: int, sample: NDArray[np.float32]):
-    # pad zero
-    remainder = sample.size % 16
-    if remainder != 0:
-      num_zeros_to_add = 16 - remainder
-      zeros_to_add = np.zeros(num_zeros_to_add, dtype=sample.dtype)
-      sample = np.concatenate((sample, zeros_to_add))
+    async with self.lock:
+      self._write(time, sample)
 
+  async def enqueue_chunks(self, chunks: Iterable[Tuple[int, NDArray[np.float32]]]):
     async with self.lock:
-      await self.queue.put((time, sample))
+      for time, sample in chunks:
+        self._write(time, sample)
+
+  def _new_utterance(self):
+    self.epoch += 1
+    self.partial_pending = False
+    if self.agreement is not None:
+      self.agreement.reset()
+    if self.language is not None:
+      self.language.end_utterance()
 
   async def discard_chunks(self):
     async with self.lock:
-      self.last_element = None
+      self.timeline.clear()
+      if self.mel_cache is not None:
+        self.mel_cache.clear()
+      self._new_utterance()
+
+  async def drop_audio(self, keep: float, new_utterance: bool = False) -> float:
+    async with self.lock:
+      timeline = self.timeline
+      size = timeline.size
+      if size <= keep * SAMPLE_RATE:
+        return 0
+      timeline.release(self._align(timeline.end - int(keep * SAMPLE_RATE)))
+      if new_utterance:
+        self._new_utterance()
+      return (size - timeline.size) / SAMPLE_RATE
+
+  def pending_duration(self) -> float:
+    return self.timeline.written / SAMPLE_RATE
+
+  def buffered_duration(self) -> float:
+    return self.timeline.size / SAMPLE_RATE
+
+  def overflow_duration(self) -> float:
+    return self.timeline.dropped / SAMPLE_RATE
+
+  def context_fallbacks(self) -> int:
+    # a batch service counts the windows of every worker sharing it
+    runner = self.batch_service.runner if self.batch_service is not None else self.reduced_model
+    return runner.fallbacks if runner is not None else 0
+
+  def _align(self, pos: int) -> int:
+    # keep partially consumed windows on the frame grid of the mel cache
+    return self.mel_cache.align(pos) if self.mel_cache is not None else pos
 
   async def transcribe_once(self) -> List[TranscriptionResult]:
     '''Transcribe the all enqueued chunks and return the result. 
@@ -123,95 +409,89 @@ class WhisperWorker(TranscribeWorker):
     if not self.model:
       return []
 
-    # TODO is this lock really necessary?
+    # the lock is only held to take the window and to release audio after
+    # the pass, so chunks keep coming in during inference
     async with self.lock:
-      if self.queue.empty():
+      timeline = self.timeline
+      if not timeline.updated or timeline.empty:
         return []
+      timeline.written = 0
+      if self.mel_cache is not None:
+        await inference_executor.run(self.mel_cache.update, timeline)
 
-      # gather data from queue
-      data: List[NDArray[np.float32]] = []
-      data_overflow: List[Tuple[int, NDArray[np.float32]]] = []
-
-      sample_length = 0
-      last_time = None
-      start_time = None
-      force_complete = False
-      max_sample_count_flag = False
-
-      if self.last_element is not None:
-        time, sample = self.last_element
-        start_time = time
-        last_time = time + sample.size // ONE_MS_SAMPLE
-        data.append(sample)
-        sample_length += sample.size
-        self.last_element = None
-
-      while not self.queue.empty():
-        _e: Tuple[int, NDArray[np.float32]] = self.queue.get_nowait()
-        time, sample = _e
-
-        # try filling the gaps
-        if last_time is not None:
-
-          if last_time < time:
-            if time - last_time > GAP_FILL_MAX:  # leave the data till next iteration
-              force_complete = True
-              self.last_element = time, sample
-              break
-            else:  # fill the gaps
-              fill = np.zeros(
-                  ((time - last_time) * ONE_MS_SAMPLE,), dtype=np.float32)
-              data.append(fill)
-              sample_length += len(fill)
-
-          if last_time > time:
-            # separate array
-            delta_time = last_time - time
-            delta_smpl_length = delta_time * ONE_MS_SAMPLE
-            delta_array = sample[:delta_smpl_length]
-
-            sample = sample[delta_smpl_length:] if delta_smpl_length < sample.size else None
-            data_overflow.append((time, delta_array))
-            print(f'last_time > time: {last_time}, {time}')
-            time = last_time  # shift the time
-
-        if sample is None:
-          continue
-
-        if start_time is None:
-          start_time = time
-        last_time = time + sample.size // ONE_MS_SAMPLE
-        data.append(sample)
-        sample_length += sample.size
-
-        # prevent for too long recognition
-        if sample_length > MAX_SAMPLE_COUNT:
-          max_sample_count_flag = True
-          break
-
-      if not data or start_time is None:
+      start_time, data_array, force_complete = timeline.window(MAX_SAMPLE_COUNT)
+      if data_array.size == 0:
         return []
-
-      # combine data
-      data_array = np.concatenate(data, axis=0)
-      while start_time != None and data_overflow:
-        timestamp, delta_array = data_overflow.pop()
-        add_pos = (timestamp - start_time) * ONE_MS_SAMPLE
-        data_array[add_pos: add_pos+delta_array.size] += delta_array
-
+      window_start = timeline.start
+      window_end = window_start + data_array.size
+      duration = data_array.size / SAMPLE_RATE
+
+      # gate the model by voice activity
+      if self.vad is not None:
+        padding = VAD_PADDING * ONE_MS_SAMPLE
+        speech = self.vad.speech_range(data_array, padding)
+        if self.partial_pending:
+          # keep the audio of the last partial result until it is completed
+          speech = 0, data_array.size if speech is None else speech[1]
+        if speech is None:
+          # keep a short tail in case speech starts right at the end
+          timeline.release(window_end if force_complete else self._align(window_end - padding))
+          timeline.updated = timeline.end > window_end
+          return []
+        speech_start, speech_end = speech
+        timeline.release(self._align(window_start + speech_start))
+        start_time = timeline.start_time
+        duration = (window_end - timeline.start) / SAMPLE_RATE
+        data_array = data_array[timeline.start - window_start: speech_end]
+
+      data_start = timeline.start
+      mel = self.mel_cache.window(data_start, data_array) \
+          if self.mel_cache is not None else None
+      # the view is overwritten by chunks written during the pass
+      data_array = data_array.copy()
+      timeline.updated = False
+      epoch = self.epoch
+
+    model = self.batch_service or self.reduced_model or self.model
+    if self.agreement is not None:
+      results, incomplete_result, sample_retain = await transcribe_streaming(
+          model,
+          data_array,
+          self.agreement,
+          start_time,
+          force_complete,
+          duration=duration,
+          language=self.language,
+          profile=self.profile,
+          final_model=self.final_model,
+          mel=mel,
+      )
+    else:
       results, incomplete_result, sample_retain = await transcribe_and_segment(
-          self.model,
+          model,
           data_array,
-          start_time if start_time else 0,
-          force_complete
+          start_time,
+          force_complete,
+          duration=duration,
+          language=self.language,
+          profile=self.profile,
+          final_model=self.final_model,
+          mel=mel,
       )
 
-      if sample_retain < data_array.size:
-        self.last_element = (
-            start_time + sample_retain // ONE_MS_SAMPLE,
-            data_array[sample_retain:]
-        )
-
-      if incomplete_result is not None:
-        results += [incomplete_result]
-      return results
+    async with self.lock:
+      if self.epoch != epoch:
+        # the audio was dropped as a new utterance during the pass
+        self._new_utterance()
+      elif force_complete or sample_retain >= data_array.size:
+        # a window cut by a break or fully transcribed is completed
+        timeline.release(window_end)
+        self.partial_pending = False
+      else:
+        timeline.release(self._align(data_start + sample_retain))
+        self.partial_pending = incomplete_result is not None
+      timeline.updated = timeline.updated or timeline.end > window_end
+
+    if incomplete_result is not None:
+      results += [incomplete_result]
+    return results
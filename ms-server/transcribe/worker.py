@@ -1,6 +1,6 @@
 import abc
 import asyncio
-from typing import List
+from typing import List, Iterable, Tuple
 from dataclasses import dataclass
 import numpy as np
 from numpy.typing import NDArray
@@ -23,6 +23,13 @@ class TranscribeWorker(abc.ABC):
   async def enqueue_chunk(self, time: int, sample: NDArray[np.float32]):
     pass
 
+  async def enqueue_chunks(self, chunks: Iterable[Tuple[int, NDArray[np.float32]]]):
+    '''Enqueue a burst of (time, sample) chunks in order. Each sample is
+    only read before the next one is taken from `chunks`.
+    '''
+    for time, sample in chunks:
+      await self.enqueue_chunk(time, sample)
+
   @abc.abstractmethod
   async def discard_chunks(self):
     pass
@@ -34,6 +41,34 @@ class TranscribeWorker(abc.ABC):
     '''
     pass
 
+  def pending_duration(self) -> float:
+    '''Seconds of audio enqueued since the last transcription.
+    '''
+    return 0
+
+  def buffered_duration(self) -> float:
+    '''Seconds of audio held by the worker, transcribed or not.
+    '''
+    return 0
+
+  def overflow_duration(self) -> float:
+    '''Seconds of audio lost because the buffer was full.
+    '''
+    return 0
+
+  def context_fallbacks(self) -> int:
+    '''Windows decoded again with the full audio context because the
+    reduced-context output degraded.
+    '''
+    return 0
+
+  async def drop_audio(self, keep: float, new_utterance: bool = False) -> float:
+    '''Discard all but the last `keep` seconds of buffered audio and return
+    the seconds discarded. With `new_utterance`, the kept audio starts a
+    new utterance.
+    '''
+    return 0
+
 
 @dataclass
 class TranscriptionResult:
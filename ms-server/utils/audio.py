@@ -0,0 +1,199 @@
+from typing import Optional, Dict, Callable, Tuple, Union
+from abc import ABC, abstractmethod
+
+import math
+import numpy as np
+from numpy.typing import NDArray
+from numpy.lib.stride_tricks import sliding_window_view
+
+try:
+  import opuslib
+except ImportError:
+  opuslib = None
+
+SAMPLE_RATE = 16000
+_INT16_SCALE = np.float32(1 / 0x8000)
+
+
+def _mulaw_table() -> NDArray[np.float32]:
+  # G.711 mu-law expansion of every code
+  codes = ~np.arange(256, dtype=np.uint8)
+  sign = (codes & 0x80) != 0
+  exponent = (codes >> 4) & 0x07
+  mantissa = codes & 0x0f
+  magnitude = (((mantissa.astype(np.int32) << 3) + 0x84) << exponent) - 0x84
+  return (np.where(sign, -magnitude, magnitude) * _INT16_SCALE).astype(np.float32)
+
+
+class AudioDecoder(ABC):
+  '''Decodes the payload of one provider message to float32 samples
+  in [-1, 1] at 16 kHz.
+
+  The returned array may be a scratch buffer of the decoder, only valid
+  until the next call.
+  '''
+
+  fixed_rate = False  # whether the output is 16 kHz mono whatever the input
+
+  def __init__(self):
+    self.scratch = np.zeros((0,), dtype=np.float32)
+
+  def _buffer(self, size: int) -> NDArray[np.float32]:
+    if self.scratch.size < size:
+      self.scratch = np.zeros((max(size, self.scratch.size * 2),), dtype=np.float32)
+    return self.scratch[:size]
+
+  @abstractmethod
+  def decode(self, data: Union[bytes, memoryview]) -> NDArray[np.float32]:
+    pass
+
+
+class Float32Decoder(AudioDecoder):
+
+  def decode(self, data: Union[bytes, memoryview]) -> NDArray[np.float32]:
+    usable = len(data) - len(data) % 4
+    return np.frombuffer(data, dtype='<f4', count=usable // 4)
+
+
+class Int16Decoder(AudioDecoder):
+
+  def __init__(self, big_endian: bool = False):
+    super().__init__()
+    self.dtype = np.dtype('>i2' if big_endian else '<i2')
+
+  def decode(self, data: Union[bytes, memoryview]) -> NDArray[np.float32]:
+    raw = np.frombuffer(data, dtype=self.dtype, count=len(data) // 2)
+    return np.multiply(raw, _INT16_SCALE, out=self._buffer(raw.size), casting='unsafe')
+
+
+class MuLawDecoder(AudioDecoder):
+
+  table = _mulaw_table()
+
+  def decode(self, data: Union[bytes, memoryview]) -> NDArray[np.float32]:
+    codes = np.frombuffer(data, dtype=np.uint8)
+    return np.take(self.table, codes, out=self._buffer(codes.size))
+
+
+class OpusDecoder(AudioDecoder):
+  '''One Opus packet per message. libopus decodes any stream to mono
+  at 16 kHz itself.
+  '''
+
+  fixed_rate = True
+
+  max_frame_size = SAMPLE_RATE * 120 // 1000  # longest Opus frame
+
+  def __init__(self):
+    super().__init__()
+    self.decoder = opuslib.Decoder(SAMPLE_RATE, 1)
+
+  def decode(self, data: Union[bytes, memoryview]) -> NDArray[np.float32]:
+    if not data:
+      return self._buffer(0)
+    pcm = self.decoder.decode_float(bytes(data), self.max_frame_size)
+    return np.frombuffer(pcm, dtype=np.float32)
+
+
+AUDIO_DECODERS: Dict[str, Callable[[], AudioDecoder]] = {
+    'float32': Float32Decoder,
+    'int16': Int16Decoder,
+    'int16le': Int16Decoder,
+    'int16be': lambda: Int16Decoder(big_endian=True),
+    'mulaw': MuLawDecoder,
+    'ulaw': MuLawDecoder,
+}
+if opuslib is not None:
+  AUDIO_DECODERS['opus'] = OpusDecoder
+
+
+def create_decoder(format: Optional[str]) -> Optional[AudioDecoder]:
+  '''Decoder of an ingest format, or None if it is not supported here.
+  '''
+  factory = AUDIO_DECODERS.get((format or 'float32').strip().lower())
+  return factory() if factory is not None else None
+
+
+class StreamResampler:
+  '''Streaming polyphase resampler from interleaved float32 audio of any
+  rate and channel count to mono at `rate_out`.
+
+  Channels are averaged, then the rate is converted by `up / down` with a
+  Kaiser-windowed sinc low-pass split into `up` phases. The tail of each
+  chunk is kept as filter history for the next one, and the buffers are
+  reused across chunks.
+  '''
+
+  def __init__(
+      self,
+      rate: int,
+      channels: int = 1,
+      rate_out: int = SAMPLE_RATE,
+      zero_crossings: int = 8,  # per side of the sinc
+      rolloff: float = 0.9,  # cutoff relative to the lower Nyquist frequency
+      beta: float = 8.6,  # Kaiser window
+  ):
+    g = math.gcd(rate, rate_out)
+    self.rate = rate
+    self.channels = channels
+    self.up = rate_out // g
+    self.down = rate // g
+
+    if self.up == self.down == 1:
+      h = np.ones((1,))
+    else:
+      ratio = max(self.up, self.down)
+      n = 2 * zero_crossings * ratio + 1
+      k = np.arange(n) - (n - 1) / 2
+      cutoff = rolloff / (2 * ratio)  # in cycles per upsampled sample
+      h = 2 * cutoff * np.sinc(2 * cutoff * k) * np.kaiser(n, beta) * self.up
+    self.delay = (h.size - 1) / 2  # in upsampled samples
+
+    # phase p holds h[p], h[p + up], ..., reversed to match the sample order
+    # of a sliding window
+    self.taps = -(-h.size // self.up)
+    phases = np.zeros((self.up * self.taps,))
+    phases[:h.size] = h
+    self.phases = np.ascontiguousarray(
+        phases.reshape(self.taps, self.up).T[:, ::-1], dtype=np.float32)
+
+    self.history = self.taps - 1
+    self.buffer = np.zeros((self.history + 4096,), dtype=np.float32)
+    self.output = np.zeros((4096,), dtype=np.float32)
+    self.t = self.history * self.up  # next output, in upsampled samples from buffer[0]
+
+  def process(self, data: NDArray[np.float32]) -> Tuple[float, NDArray[np.float32]]:
+    '''Resample a chunk. Returns the position of the first output sample
+    relative to the start of the chunk, in ms, and the output samples, which
+    are only valid until the next call.
+    '''
+    frames = data.size // self.channels
+    size = self.history + frames
+    if size > self.buffer.size:
+      buffer = np.zeros((max(size, self.buffer.size * 2),), dtype=np.float32)
+      buffer[:self.history] = self.buffer[:self.history]
+      self.buffer = buffer
+    x = self.buffer[:size]
+    if self.channels > 1:
+      np.mean(data[:frames * self.channels].reshape(frames, self.channels), axis=1, out=x[self.history:])
+    else:
+      x[self.history:] = data[:frames]
+
+    up, down = self.up, self.down
+    t0 = self.t
+    count = max(-(-(size * up - t0) // down), 0)
+    if count > self.output.size:
+      self.output = np.zeros((max(count, self.output.size * 2),), dtype=np.float32)
+    y = self.output[:count]
+    windows = sliding_window_view(x, self.taps)
+    for r in range(min(up, count)):
+      # outputs r, r + up, ... share a phase and step `down` inputs apart
+      t = t0 + r * down
+      i = t // up - self.history
+      n = len(range(r, count, up))
+      np.matmul(windows[i:: down][:n], self.phases[t % up], out=y[r:: up][:n])
+
+    offset = ((t0 - self.delay) / up - self.history) / self.rate * 1000
+    self.t = t0 + count * down - frames * up
+    self.buffer[:self.history] = x[frames:]
+    return offset, y
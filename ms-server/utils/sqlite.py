@@ -3,55 +3,127 @@ Reference: https://gist.github.com/xsduan/09fb145da3da3a78f5ca844b155f27aa
 Temporary module to allow for sqlite databases during development. Remove once
 we get an actual database.
 """
+import asyncio
 import peewee
 import aiosqlite
 from peewee_async import AsyncDatabase
 import functools
 
+DEFAULT_PRAGMAS = (
+    ('journal_mode', 'wal'),  # readers do not block the writer
+    ('synchronous', 'normal'),  # fsync on checkpoints only, safe with WAL
+    ('cache_size', -16000),  # 16 MiB page cache per connection
+    ('mmap_size', 268435456),  # 256 MiB
+    ('temp_store', 'memory'),
+)
+
 
 class AsyncSqliteConnection:
-  def __init__(self, *, database=None, loop=None, timeout=None, **kwargs):
-    self._created_connections = []
+  '''Pool of long-lived aiosqlite connections.
+
+  Connections are opened lazily up to `pool_size`, set up with `pragmas`
+  once, and reused, so their statement caches stay warm. They run in
+  autocommit mode: a query outside of a transaction commits on its own,
+  and transactions are scoped by the BEGIN / COMMIT peewee_async issues on
+  the connection it holds.
+  '''
+
+  def __init__(
+      self, *,
+      database=None,
+      loop=None,
+      timeout=None,
+      pool_size=4,
+      pragmas=DEFAULT_PRAGMAS,
+      cached_statements=256,
+      **kwargs
+  ):
     self.loop = loop
     self.database = database
     self.timeout = timeout
+    self.pool_size = pool_size
+    self.pragmas = list(pragmas.items()) if isinstance(pragmas, dict) else list(pragmas)
+    self.cached_statements = cached_statements
     self.connect_params = kwargs
 
+    self._connections = []
+    self._idle = []
+    self._available = asyncio.Semaphore(pool_size)
+
+  async def _open(self):
+    params = dict(self.connect_params)
+    if self.timeout is not None:
+      params['timeout'] = self.timeout
+    conn = await aiosqlite.connect(
+        self.database,
+        isolation_level=None,
+        cached_statements=self.cached_statements,
+        **params
+    )
+    try:
+      await conn.executescript(''.join(
+          f'PRAGMA {pragma} = {value};' for pragma, value in self.pragmas))
+    except Exception:
+      await conn.close()
+      raise
+    self._connections.append(conn)
+    return conn
+
   async def acquire(self):
-    conn = aiosqlite.connect(database=self.database, **self.connect_params)
-    self._created_connections.append(conn)
-    return await conn.__aenter__()
+    '''Take an idle connection, or open one if the pool is not full.
+    '''
+    await self._available.acquire()
+    try:
+      if self._idle:
+        conn = self._idle.pop()
+        if conn.in_transaction:
+          # left behind by a transaction that was interrupted
+          await conn.rollback()
+        return conn
+      return await self._open()
+    except BaseException:
+      self._available.release()
+      raise
 
-  async def release(self, conn):
-    if conn in self._created_connections:
-      self._created_connections.remove(conn)
-    await conn.commit()
-    await conn.__aexit__(None, None, None)
+  def release(self, conn):
+    '''Give a connection back to the pool. peewee_async calls this without
+    awaiting it, so it must not block.
+    '''
+    if conn in self._connections:
+      self._idle.append(conn)
+    self._available.release()
 
   async def connect(self):
+    # connections are opened on demand
     pass
 
   async def close(self):
-    for conn in self._created_connections:
-      await conn.__aexit__(None, None, None)
-    self._created_connections = []
+    connections, self._connections, self._idle = self._connections, [], []
+    for conn in connections:
+      await conn.close()
 
   async def cursor(self, conn=None, *args, **kwargs):
     in_transaction = conn is not None
     if not conn:
       conn = await self.acquire()
-    cursor = await conn.cursor(*args, **kwargs)
+    try:
+      cursor = await conn.cursor(*args, **kwargs)
+    except BaseException:
+      if not in_transaction:
+        self.release(conn)
+      raise
     cursor.release = functools.partial(
         self.release_cursor,
-        cursor, in_transaction=in_transaction
+        cursor, conn, in_transaction=in_transaction
     )
     return cursor
 
-  async def release_cursor(self, cursor, in_transaction=False):
-    conn = cursor._conn
-    await cursor.__aexit__(None, None, None)
-    if not in_transaction:
-      await self.release(conn)
+  async def release_cursor(self, cursor, conn, in_transaction=False):
+    try:
+      await cursor.close()
+    finally:
+      if not in_transaction:
+        self.release(conn)
 
 
 class AsyncSqliteMixin(AsyncDatabase):
@@ -61,7 +133,7 @@ class AsyncSqliteMixin(AsyncDatabase):
 
   @property
   def connect_params_async(self):
-    return {**self.connect_params}
+    return {**self.connect_params, 'pragmas': self._pragmas}
 
   async def last_insert_id_async(self, cursor):
     """Get ID of last inserted row.
@@ -70,6 +142,15 @@ class AsyncSqliteMixin(AsyncDatabase):
 
 
 class AsyncSqliteDatabase(AsyncSqliteMixin, peewee.SqliteDatabase):
-  def init(self, database, **kwargs):
-    super().init(database, **kwargs)
+  def init(self, database, pragmas=None, **kwargs):
+    # the pool of a previous file would keep serving queries
+    conn, self._async_conn = self._async_conn, None
+    self._async_wait = None
+    self._task_data = None
+    if conn is not None:
+      asyncio.ensure_future(conn.close())
+
+    if pragmas is None and not getattr(self, '_pragmas', None):
+      pragmas = DEFAULT_PRAGMAS
+    super().init(database, pragmas=pragmas, **kwargs)
     self.init_async()